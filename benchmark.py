@@ -0,0 +1,287 @@
+"""Replays webhook traffic through lambda_handler against local stub servers for every upstream.
+
+ShipStation, the MLP user-api, FedEx and UPS are each served by a local HTTP server with configurable latency
+and 429 rate, so performance changes can be measured without touching production APIs. Reports throughput,
+p50/p99 per-order latency and the number of requests each upstream received.
+
+    python benchmark.py [capture.jsonl] [--runs N] [--orders N] [--latency MS] [--jitter MS] [--rate-429 P]
+    python benchmark.py --cold-start N
+
+Each line of a capture file is one recorded webhook, holding the orders its resource_url returned and,
+optionally, the user-api record for each order number:
+
+    {"orders": [<ShipStation order>, ...], "mlp": {"10525": <user-api record>, ...}}
+
+Without a capture file, a single webhook of --orders synthetic orders is generated from config.sku_to_pouches.
+--cold-start imports order_processor in N fresh interpreters instead and reports its INIT_DURATION.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import config
+import functions
+import order_processor
+
+SHIPSTATION_PAGE_SIZE = 100
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.upstream.handle(self)
+
+    def do_POST(self):
+        self.server.upstream.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubUpstream:
+    """One upstream API on a local port. Routes map (method, path) to a function(query, body) -> (status, payload)."""
+
+    def __init__(self, name, routes, latency, jitter, rate_429, retry_after, seed):
+        self.name = name
+        self.routes = routes
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.upstream = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, request):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        url = urlsplit(request.path)
+
+        with self.lock:
+            self.requests += 1
+            delay = max(self.random.gauss(self.latency, self.jitter), 0) / 1000
+            throttle = self.random.random() < self.rate_429
+            if throttle:
+                self.throttled += 1
+        time.sleep(delay)
+
+        headers = {}
+        route = self.routes.get((request.command, url.path))
+        if throttle:
+            status, payload = 429, {'message': 'Too Many Requests'}
+            headers['Retry-After'] = str(self.retry_after)
+        elif route is None:
+            status, payload = 404, {'message': f"No stub for {request.command} {url.path}"}
+        else:
+            status, payload = route(parse_qs(url.query), body)
+
+        content = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        for header, value in headers.items():
+            request.send_header(header, value)
+        request.end_headers()
+        request.wfile.write(content)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def quote(carrier, pounds):
+    # Deterministic so the same shipment always picks the same carrier
+    base, per_pound = {'fedex': (8.5, 0.9), 'ups': (8.75, 0.85), 'shipstation_ups': (9.0, 0.8), 'usps': (7.25, 1.1)}[carrier]
+    return round(base + per_pound * pounds, 2)
+
+
+def build_upstreams(webhooks, args):
+    def resource_page(query, body):
+        orders = webhooks[int(query['webhook'][0])]['orders']
+        page = int(query.get('page', ['1'])[0])
+        pages = max(math.ceil(len(orders) / SHIPSTATION_PAGE_SIZE), 1)
+        start = (page - 1) * SHIPSTATION_PAGE_SIZE
+        return 200, {'orders': orders[start:start + SHIPSTATION_PAGE_SIZE], 'total': len(orders), 'page': page, 'pages': pages}
+
+    def shipstation_rates(query, body):
+        payload = json.loads(body)
+        carrier = 'shipstation_ups' if payload.get('carrierCode') == 'ups_walleted' else 'usps'
+        return 200, [{'shipmentCost': quote(carrier, payload['weight']['value'] / 16), 'otherCost': 0}]
+
+    def create_orders(query, body):
+        orders = json.loads(body)
+        results = [{'orderNumber': order['orderNumber'], 'orderKey': order.get('orderKey'), 'orderId': index + 1,
+                    'success': True, 'errorMessage': None} for index, order in enumerate(orders)]
+        return 200, {'hasErrors': False, 'results': results}
+
+    def mlp_record(query, body):
+        order_number = query.get('shopify_order_no', [''])[0]
+        for webhook in webhooks:
+            record = webhook.get('mlp', {}).get(order_number)
+            if record is not None:
+                return 200, [record]
+        return 200, [{'green_sprayers': 0, 'yellow_sprayers': 0, 'plan_details': []}]
+
+    def oauth_token(query, body):
+        return 200, {'access_token': 'benchmark-token', 'expires_in': 3600}
+
+    def fedex_rate(query, body):
+        payload = json.loads(body)
+        pounds = float(payload['requestedShipment']['requestedPackageLineItems'][0]['weight']['value'])
+        return 200, {'output': {'rateReplyDetails': [{'ratedShipmentDetails': [{'totalNetCharge': quote('fedex', pounds)}]}]}}
+
+    def ups_rate(query, body):
+        payload = json.loads(body)
+        try:
+            pounds = float(payload['RateRequest']['Shipment']['Package']['PackageWeight']['Weight'])
+        except (KeyError, TypeError, ValueError):
+            pounds = 1
+        return 200, {'RateResponse': {'RatedShipment': {'NegotiatedRateCharges': {'TotalCharge': {'MonetaryValue': str(quote('ups', pounds))}}}}}
+
+    routes = {
+        'shipstation': {
+            ('GET', '/orders'): resource_page,
+            ('POST', '/shipments/getrates'): shipstation_rates,
+            ('POST', '/orders/createorders'): create_orders
+        },
+        'mlp': {('GET', '/order'): mlp_record},
+        'fedex': {('POST', '/oauth/token'): oauth_token, ('POST', '/rate/v1/rates/quotes'): fedex_rate},
+        'ups': {('POST', '/security/v1/oauth/token'): oauth_token, ('POST', '/ship/v1/rating/Rate'): ups_rate}
+    }
+    return {name: StubUpstream(name, upstream_routes, args.latency, args.jitter, args.rate_429, args.retry_after, args.seed + index)
+            for index, (name, upstream_routes) in enumerate(routes.items())}
+
+
+def synthetic_webhook(count, seed):
+    rng = random.Random(seed)
+    # Hero variants without a base pouch count are never sold on their own
+    skus = sorted(sku for sku in config.sku_to_pouches if not functions.sku_info(sku).hero or functions.sku_info(sku).base_pouches)
+    orders = []
+    for index in range(count):
+        order_number = str(20000 + index)
+        items = [{'sku': sku, 'name': sku, 'quantity': rng.randint(1, 3)} for sku in rng.sample(skus, rng.randint(1, min(3, len(skus))))]
+        orders.append({
+            'orderNumber': order_number,
+            'orderKey': f"benchmark-{order_number}",
+            'orderId': int(order_number),
+            'orderStatus': 'awaiting_shipment',
+            'items': items,
+            'weight': {'value': 16 * sum(item['quantity'] for item in items), 'units': 'ounces'},
+            'dimensions': {'length': 12, 'width': 10, 'height': 4, 'units': 'inches'},
+            'shipTo': {'postalCode': f"{rng.randint(10000, 99999)}", 'residential': rng.random() < 0.8, 'state': 'CA', 'city': 'Los Angeles'},
+            'advancedOptions': {'customField1': '', 'storeId': 1},
+            'tagIds': None
+        })
+    return {'orders': orders}
+
+
+def load_capture(path):
+    with open(path) as capture:
+        return [json.loads(line) for line in capture if line.strip()]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(int(math.ceil(fraction * len(ordered))) - 1, len(ordered) - 1)] if fraction else ordered[0]
+
+
+def run(webhooks, upstreams, args):
+    functions.SHIPSTATION_API_URL = upstreams['shipstation'].url
+    functions.MLP_API_URL = upstreams['mlp'].url
+    functions.FEDEX_API_URL = upstreams['fedex'].url
+    functions.UPS_OAUTH_URL = functions.UPS_API_URL = upstreams['ups'].url
+    # Every run replays the same orders, so the dedup store would skip them all after the first
+    functions.IDEMPOTENCY_STORE = None
+    functions.idempotency_store = None
+    # Paced at ShipStation's own 40 requests/minute unless asked otherwise; 0 measures without the pacer
+    functions.shipstation_limiter = functions.RateLimiter(args.shipstation_limit or 1_000_000)
+
+    latencies = []
+    statuses = {}
+    orders = 0
+    elapsed = 0
+    for _ in range(args.runs):
+        if not args.warm_cache:
+            functions.rate_cache = functions.RateCache(functions.RATE_CACHE_TTL, functions.RATE_CACHE_MAX_ENTRIES)
+        for index, webhook in enumerate(webhooks):
+            event = {'body': json.dumps({'resource_url': f"{upstreams['shipstation'].url}/orders?webhook={index}"})}
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+            start = time.perf_counter()
+            with output:
+                response = order_processor.lambda_handler(event, None)
+            elapsed += time.perf_counter() - start
+
+            orders += len(webhook['orders'])
+            for order_properties in functions.current_metrics.get().orders.values():
+                if 'PipelineLatency' in order_properties:
+                    latencies.append(order_properties['PipelineLatency'])
+            for entry in json.loads(response['body'])['orders'].values():
+                statuses[entry['status']] = statuses.get(entry['status'], 0) + 1
+    return orders, elapsed, latencies, statuses
+
+
+def measure_cold_starts(count):
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    command = [sys.executable, '-c', "import order_processor; print(order_processor.INIT_DURATION)"]
+    durations = [float(subprocess.run(command, env=environment, capture_output=True, text=True, check=True).stdout.split()[-1])
+                 for _ in range(count)]
+    print(f"Cold start over {count} interpreters: p50 {percentile(durations, 0.5):.1f} ms, p99 {percentile(durations, 0.99):.1f} ms, "
+          f"max {max(durations):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', nargs='?', help="JSONL capture of webhooks to replay; synthetic orders are used if omitted")
+    parser.add_argument('--orders', type=int, default=50, help="synthetic orders to generate without a capture")
+    parser.add_argument('--runs', type=int, default=1, help="times to replay the capture")
+    parser.add_argument('--latency', type=float, default=50, help="mean upstream latency in milliseconds")
+    parser.add_argument('--jitter', type=float, default=15, help="standard deviation of upstream latency in milliseconds")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of upstream requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0, help="Retry-After seconds sent with each 429")
+    parser.add_argument('--shipstation-limit', type=int, default=40, help="requests/minute for the ShipStation pacer; 0 for unpaced")
+    parser.add_argument('--warm-cache', action='store_true', help="keep the rate cache between runs")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="show the function's own logs")
+    parser.add_argument('--cold-start', type=int, metavar='N', help="measure module init in N fresh interpreters instead")
+    args = parser.parse_args()
+
+    if args.cold_start:
+        measure_cold_starts(args.cold_start)
+        return
+
+    webhooks = load_capture(args.capture) if args.capture else [synthetic_webhook(args.orders, args.seed)]
+    upstreams = build_upstreams(webhooks, args)
+    try:
+        orders, elapsed, latencies, statuses = run(webhooks, upstreams, args)
+    finally:
+        for upstream in upstreams.values():
+            upstream.close()
+
+    print(f"Replayed {len(webhooks)} webhooks x {args.runs} runs: {orders} orders in {elapsed:.2f}s ({orders / elapsed if elapsed else 0:.1f} orders/s)")
+    print(f"Per-order latency: p50 {percentile(latencies, 0.5):.1f} ms, p99 {percentile(latencies, 0.99):.1f} ms")
+    print("Requests per upstream: " + ", ".join(f"{name} {upstream.requests} ({upstream.throttled} throttled)" for name, upstream in upstreams.items()))
+    print("Shipment outcomes: " + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+
+
+if __name__ == '__main__':
+    main()
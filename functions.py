@@ -1,16 +1,22 @@
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 import config
-import copy
 import uuid
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import threading
+import contextvars
+import functools
+from contextlib import contextmanager
 import json
+import os
 import time
-from typing import List, Tuple
+import hashlib
+import math
+from collections import OrderedDict, defaultdict
+from types import MappingProxyType
 from datetime import datetime
-from dateutil import tz
 
 auth_string = f"{config.SHIPSTATION_API_KEY}:{config.SHIPSTATION_API_SECRET}"
 encoded_auth_string = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
@@ -21,51 +27,553 @@ headers = {
     "X-Partner": config.x_partner
 }
 
+# Module-level state (this session, the token and rate caches, breakers, rate table, pools) outlives one invocation
+# because Lambda reuses the module across warm invocations. The session is shared by every upstream so TLS
+# connections stay open; ShipStation's credentials are added per request by shipstation_request.
 session = requests.Session()
-session.headers.update(headers)
+session.headers.update({"Content-Type": "application/json"})
+
+# Upstream base URLs, overridable so benchmark.py and local runs can point them at stub servers
+SHIPSTATION_API_URL = getattr(config, 'SHIPSTATION_API_URL', 'https://ssapi.shipstation.com')
+MLP_API_URL = getattr(config, 'MLP_API_URL', 'https://user-api-dev-qhw6i22s2q-uc.a.run.app')
+FEDEX_API_URL = getattr(config, 'FEDEX_API_URL', 'https://apis.fedex.com')
+UPS_OAUTH_URL = getattr(config, 'UPS_OAUTH_URL', 'https://wwwcie.ups.com')
+UPS_API_URL = getattr(config, 'UPS_API_URL', 'https://onlinetools.ups.com')
+
+# Shared pool for outbound requests (carrier quotes, MLP lookups, bulk submissions). Only leaf requests run here and never wait on other tasks in the pool, so it cannot deadlock.
+IO_WORKERS = getattr(config, 'IO_WORKERS', 16)
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
+METRICS_NAMESPACE = getattr(config, 'METRICS_NAMESPACE', 'OrderProcessor')
+
+# Order the current task is working on, so timings recorded deep in the call stack are attributed to it
+current_order = contextvars.ContextVar('current_order', default=None)
+
+
+def submit_io(function, *args, order_number=None):
+    # Carry the caller's context (current order and ledger) into the pool thread, or attribute the work to order_number
+    context = contextvars.copy_context()
+    if order_number is not None:
+        context.run(current_order.set, order_number)
+    return io_executor.submit(context.run, function, *args)
+
+
+# Latencies and counters for one invocation, printed as CloudWatch Embedded Metric Format lines
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(list)  # (name, unit, dimension, dimension value) -> values
+        self.orders = defaultdict(dict)  # order number -> {property: total}
+
+    def record(self, name, value, unit='Milliseconds', dimension=None, dimension_value=None, per_order=True, order_number=None):
+        # Attributed to the current task's order unless the caller names one
+        if order_number is None and per_order:
+            order_number = current_order.get()
+        with self.lock:
+            self.values[(name, unit, dimension, dimension_value)].append(value)
+            if order_number:
+                order_properties = self.orders[order_number]
+                key = f"{name}.{dimension_value}" if dimension_value else name
+                order_properties[key] = order_properties.get(key, 0) + value
+
+    def count(self, name):
+        with self.lock:
+            return sum(sum(recorded) for (key, unit, _, _), recorded in self.values.items() if key == name and unit == 'Count')
+
+    @contextmanager
+    def timer(self, name, dimension=None, dimension_value=None, per_order=True):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, round((time.perf_counter() - start) * 1000, 3), 'Milliseconds', dimension, dimension_value, per_order)
+
+    def emit(self):
+        timestamp = int(time.time() * 1000)
+        with self.lock:
+            values = dict(self.values)
+            orders = dict(self.orders)
+
+        for (name, unit, dimension, dimension_value), recorded in values.items():
+            if unit == 'Count':
+                recorded = [sum(recorded)]
+            # EMF accepts at most 100 values per metric per line
+            for start in range(0, len(recorded), 100):
+                line = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [[dimension]] if dimension else [[]], "Metrics": [{"Name": name, "Unit": unit}]}]
+                    },
+                    name: recorded[start:start + 100]
+                }
+                if dimension:
+                    line[dimension] = dimension_value
+                print(json.dumps(line), flush=True)
+
+        # One line per order; its stage timings, retries, cache hits and waits ride along as searchable properties
+        for order_number, order_properties in orders.items():
+            line = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [[]], "Metrics": [{"Name": "OrderLatency", "Unit": "Milliseconds"}]}]
+                },
+                "OrderNumber": order_number,
+                "OrderLatency": order_properties.get('PipelineLatency', 0),
+                **order_properties
+            }
+            print(json.dumps(line), flush=True)
+
+
+# Metrics of the invocation the current task works for, set by lambda_handler and carried like current_ledger, so a late
+# quote records into its own invocation's metrics. The default only collects work done outside an invocation
+current_metrics = contextvars.ContextVar('current_metrics', default=Metrics())
+
+
+def timed_stage(stage, per_order=True):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with current_metrics.get().timer('StageLatency', 'Stage', stage, per_order):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Token bucket pacing ShipStation calls under its per-minute budget; X-Rate-Limit-* headers correct it
+class RateLimiter:
+    def __init__(self, limit, period=60):
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.resume_at = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+
+    # Waits for a token; with a timeout, gives up and returns False as soon as none can free up in time
+    def acquire(self, timeout=None):
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        waited = 0
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.refill(now)
+                    if now >= self.resume_at and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = max(self.resume_at - now, (1 - self.tokens) * self.period / self.limit)
+                if give_up_at is not None and now + wait > give_up_at:
+                    return False
+                time.sleep(wait)
+                waited += wait
+        finally:
+            if waited:
+                current_metrics.get().record('RateLimitWait', round(waited * 1000, 3), 'Milliseconds', 'Upstream', 'shipstation')
+
+    def update(self, response):
+        try:
+            limit = int(response.headers.get('X-Rate-Limit-Limit', self.limit))
+            remaining = response.headers.get('X-Rate-Limit-Remaining')
+            reset = response.headers.get('X-Rate-Limit-Reset')
+            remaining = int(remaining) if remaining is not None else None
+            reset = int(reset) if reset is not None else None
+        except (TypeError, ValueError):
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.limit = max(limit, 1)
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+            if reset is not None and (response.status_code == 429 or remaining == 0):
+                self.tokens = 0
+                self.resume_at = max(self.resume_at, now + reset)
+
+
+shipstation_limiter = RateLimiter(getattr(config, 'SHIPSTATION_RATE_LIMIT', 40))
+
+
+# A request under a deadline found the ShipStation budget spent
+class PacerExhausted(Exception):
+    pass
+
+
+# A carrier couldn't quote right now (open circuit, pacing, timeout, 429/5xx), as opposed to refusing the shipment
+class RateUnavailable(Exception):
+    pass
+
+
+# Our own ShipStation budget, not the carrier, kept the quote from going out before its deadline
+class RatePaced(RateUnavailable):
+    pass
+
+
+# Monotonic time after which nobody wants the answer to the current upstream call, e.g. a carrier quote past its
+# rate-shopping deadline. Requests made under one neither wait on the pacer nor back off past it, so they never hold
+# a pool worker for time the caller won't wait
+call_deadline = contextvars.ContextVar('call_deadline', default=None)
+
+RETRY_ATTEMPTS = getattr(config, 'RETRY_ATTEMPTS', 4)
+RETRY_BASE_DELAY = getattr(config, 'RETRY_BASE_DELAY', 1)
+RETRY_MAX_DELAY = getattr(config, 'RETRY_MAX_DELAY', 60)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_delay(response, attempt):
+    # Prefer the server's own hint about when to come back
+    if response is not None:
+        hint_headers = ['Retry-After', 'X-Rate-Limit-Reset'] if response.status_code == 429 else ['Retry-After']
+        for header in hint_headers:
+            try:
+                return min(float(response.headers[header]), RETRY_MAX_DELAY) + random.uniform(0, RETRY_BASE_DELAY)
+            except (KeyError, TypeError, ValueError):
+                continue
+    # Otherwise exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+# Caps on simultaneous in-flight requests per upstream, shared by every worker thread
+UPSTREAM_CONCURRENCY = {'shipstation': 8, 'mlp': 8, 'fedex': 8, 'ups': 8}
+UPSTREAM_CONCURRENCY.update(getattr(config, 'UPSTREAM_CONCURRENCY', {}))
+upstream_semaphores = {upstream: threading.BoundedSemaphore(limit) for upstream, limit in UPSTREAM_CONCURRENCY.items()}
+
+# Each host gets its own keep-alive pool, large enough that every slot its semaphore hands out has a connection to reuse
+http_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max(UPSTREAM_CONCURRENCY.values()))
+session.mount('https://', http_adapter)
+session.mount('http://', http_adapter)
+
+# (connect, read) seconds per endpoint; quotes don't read longer than rate shopping would wait for them
+HTTP_TIMEOUTS = {
+    'shipstation': (3.05, 30),
+    'shipstation_rates': (3.05, 8),
+    'mlp': (3.05, 10),
+    'fedex': (3.05, 8),
+    'ups': (3.05, 8)
+}
+HTTP_TIMEOUTS.update(getattr(config, 'HTTP_TIMEOUTS', {}))
+
+
+# What send_with_retry saw of one upstream call's HTTP attempts
+class AttemptLog:
+    __slots__ = ('slowest', 'count', 'last_status')
+
+    def __init__(self):
+        self.slowest = 0  # Seconds taken by the slowest single attempt
+        self.count = 0
+        self.last_status = None  # Status code of the last attempt; None if it got no response
+
+    # Last attempt timed out, failed to connect, was throttled or hit a server error
+    def ended_transiently(self):
+        return self.count > 0 and (self.last_status is None or self.last_status in RETRYABLE_STATUS_CODES)
+
+
+# Set by callers that judge an upstream's health, so circuit breakers see its own response times rather than the
+# client-side pacing, concurrency waits and retry backoff around them
+attempt_log = contextvars.ContextVar('attempt_log', default=None)
+
+
+@contextmanager
+def logged_attempts():
+    log = AttemptLog()
+    token = attempt_log.set(log)
+    try:
+        yield log
+    finally:
+        attempt_log.reset(token)
+
+
+# Repeats only the failing request, backing off in between; pacing and backoff don't hold a concurrency slot
+def send_with_retry(send, upstream, attempts=RETRY_ATTEMPTS, pace=None):
+    log = attempt_log.get()
+    for attempt in range(attempts):
+        response = None
+        if pace is not None:
+            pace()
+        error = None
+        try:
+            with upstream_semaphores[upstream]:
+                start = time.perf_counter()
+                try:
+                    response = send()
+                finally:
+                    elapsed = time.perf_counter() - start
+                    current_metrics.get().record('UpstreamLatency', round(elapsed * 1000, 3), 'Milliseconds', 'Upstream', upstream)
+                    if log is not None:
+                        log.slowest = max(log.slowest, elapsed)
+                        log.count += 1
+                        log.last_status = response.status_code if response is not None else None
+            if response.status_code not in RETRYABLE_STATUS_CODES or attempt == attempts - 1:
+                return response
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == attempts - 1:
+                raise
+            error = e
+        delay = retry_delay(response, attempt)
+        deadline = call_deadline.get()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            # The caller stops waiting before the next attempt could start; hand back what we have
+            if error is not None:
+                raise error
+            return response
+        current_metrics.get().record('Retries', 1, 'Count', 'Upstream', upstream)
+        status = response.status_code if response is not None else 'connection error'
+        print(f"Request failed ({status}); retrying in {delay:.1f}s (attempt {attempt + 2} of {attempts})", flush=True)
+        time.sleep(delay)
+
+
+def take_shipstation_token():
+    # Requests under a deadline wait for a token only as long as their caller waits for them
+    deadline = call_deadline.get()
+    if not shipstation_limiter.acquire(None if deadline is None else deadline - time.monotonic()):
+        raise PacerExhausted("ShipStation request budget is spent until after the deadline")
+
+
+def shipstation_request(method, url, **kwargs):
+    kwargs['headers'] = {**headers, **kwargs.get('headers', {})}
+    kwargs.setdefault('timeout', HTTP_TIMEOUTS['shipstation'])
+
+    def send():
+        response = session.request(method, url, **kwargs)
+        shipstation_limiter.update(response)
+        return response
+    return send_with_retry(send, 'shipstation', pace=take_shipstation_token)
+
+
+# A circuit opens after this many consecutive failures; calls with an HTTP attempt slower than CIRCUIT_SLOW_CALL_SECONDS
+# count as failures
+CIRCUIT_FAILURE_THRESHOLD = getattr(config, 'CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_SLOW_CALL_SECONDS = getattr(config, 'CIRCUIT_SLOW_CALL_SECONDS', 5)
+# Seconds an open circuit skips calls before letting a probe through
+CIRCUIT_COOLDOWN = getattr(config, 'CIRCUIT_COOLDOWN', 30)
+
+
+# Closed -> open after repeated failures -> half-open after the cooldown, letting one probe through
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, slow_call_seconds=CIRCUIT_SLOW_CALL_SECONDS, cooldown=CIRCUIT_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and now - self.opened_at < self.cooldown:
+                allowed = False
+            elif self.probe_started is not None and now - self.probe_started < self.cooldown:
+                # A probe is already out; keep skipping until it reports back (or is presumed lost)
+                allowed = False
+            else:
+                self.state = 'half_open'
+                self.probe_started = now
+                allowed = True
+        if not allowed:
+            current_metrics.get().record('CircuitOpen', 1, 'Count', 'Upstream', self.name)
+        return allowed
+
+    def record(self, succeeded, seconds=0):
+        succeeded = succeeded and seconds < self.slow_call_seconds
+        with self.lock:
+            if succeeded:
+                if self.state != 'closed':
+                    print(f"Circuit for {self.name} closed; upstream recovered", flush=True)
+                self.state = 'closed'
+                self.failures = 0
+                self.probe_started = None
+                return
+
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f"Circuit for {self.name} opened after {self.failures} consecutive failures; skipping it for {self.cooldown}s", flush=True)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_started = None
+
+
+circuit_breakers = {upstream: CircuitBreaker(upstream) for upstream in ('fedex', 'ups', 'shipstation_rates', 'mlp')}
+
+# Breaker guarding each rate-shopping carrier; both ShipStation-quoted carriers share the getrates endpoint
+CARRIER_CIRCUITS = {'fedex': 'fedex', 'ups': 'ups', 'ups_walleted': 'shipstation_rates', 'stamps_com': 'shipstation_rates'}
+
+
+@functools.lru_cache(maxsize=None)
+def pacific_timezone():
+    # Only UPS transaction ids need it, so dateutil stays out of the cold start
+    from dateutil import tz
+    return tz.gettz('US/Pacific')
+
+
+# Status ('pending', 'submitted', 'skipped', 'failed'), reasons and retryability of each order in one invocation
+class ResultLedger:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Set when the resource_url's pages couldn't all be fetched, so the caller knows to retry the webhook
+        self.incomplete_fetch = None
+
+    def _entry(self, order_number, reason=None):
+        # Callers hold self.lock
+        entry = self.entries.setdefault(order_number, {'status': 'pending', 'reasons': [], 'retryable': False})
+        if reason and reason not in entry['reasons']:
+            entry['reasons'].append(reason)
+        return entry
+
+    # A problem that didn't stop the order from going out
+    def note(self, order_number, reason):
+        with self.lock:
+            self._entry(order_number, reason)
+
+    def fail(self, order_number, reason, retryable=False):
+        with self.lock:
+            entry = self._entry(order_number, reason)
+            # An order is only worth retrying if every failure recorded against it was transient
+            entry['retryable'] = retryable if entry['status'] != 'failed' else entry['retryable'] and retryable
+            entry['status'] = 'failed'
+
+    def submitted(self, order_number, order_id):
+        with self.lock:
+            entry = self._entry(order_number)
+            entry['orderId'] = order_id
+            if entry['status'] != 'failed':
+                entry['status'] = 'submitted'
+
+    def skipped(self, order_number, reason):
+        with self.lock:
+            self._entry(order_number, reason)['status'] = 'skipped'
+
+    def shipments(self, order_number):
+        # A split order's shipments are numbered '<order number>-<n>'
+        with self.lock:
+            return [dict(entry) for shipment_number, entry in self.entries.items()
+                    if shipment_number == order_number or shipment_number.startswith(f"{order_number}-")]
+
+    def fetch_incomplete(self, page, pages):
+        with self.lock:
+            self.incomplete_fetch = {'page': page, 'pages': pages}
+
+    def with_status(self, status):
+        with self.lock:
+            return [order_number for order_number, entry in self.entries.items() if entry['status'] == status]
+
+    def with_reason(self, reason):
+        with self.lock:
+            return [order_number for order_number, entry in self.entries.items() if reason in entry['reasons']]
+
+    def summary(self):
+        with self.lock:
+            orders = {order_number: dict(entry, reasons=list(entry['reasons'])) for order_number, entry in self.entries.items()}
+            incomplete_fetch = self.incomplete_fetch
+        return {
+            'orders': orders,
+            'failed': [order_number for order_number, entry in orders.items() if entry['status'] == 'failed'],
+            'retryable': [order_number for order_number, entry in orders.items() if entry['retryable']],
+            'incompleteFetch': incomplete_fetch
+        }
+
+
+# Ledger of the invocation the current task works for, set by lambda_handler and carried into pool threads with the rest
+# of the context. A quote still running after its invocation has returned writes to that invocation's ledger, not the next one's
+current_ledger = contextvars.ContextVar('current_ledger')
 
-# Get Pacific timezone object
-tz_us_pacific = tz.gettz('US/Pacific')
+# Seconds to wait on each carrier's quote, counted from when the quote is sent, before moving on without it.
+# RATE_SHOP_TIMEOUT bounds a shipment's whole rate shop, counted from when its first quote waits for a slot, so time
+# spent queueing for RATE_SHOP_MAX_IN_FLIGHT comes out of it too
+RATE_SHOP_CARRIER_TIMEOUTS = getattr(config, 'RATE_SHOP_CARRIER_TIMEOUTS', {'fedex': 8, 'ups_walleted': 8, 'ups': 8, 'stamps_com': 8})
+RATE_SHOP_TIMEOUT = getattr(config, 'RATE_SHOP_TIMEOUT', 10)
+# Carrier quotes in flight at once across all rate shopping, kept below IO_WORKERS so a quote starts running as soon
+# as it is sent instead of queueing behind others, and MLP lookups and submissions still find a free worker
+RATE_SHOP_MAX_IN_FLIGHT = getattr(config, 'RATE_SHOP_MAX_IN_FLIGHT', max(IO_WORKERS * 3 // 4, 1))
 
-# Get the current datetime in local timezone
-start_time = datetime.now(tz_us_pacific)
+# Quotes are reused for shipments that match on everything but weight within the same bucket (ounces)
+RATE_CACHE_TTL = getattr(config, 'RATE_CACHE_TTL', 900)
+RATE_CACHE_MAX_ENTRIES = getattr(config, 'RATE_CACHE_MAX_ENTRIES', 1024)
+RATE_CACHE_WEIGHT_BUCKET = getattr(config, 'RATE_CACHE_WEIGHT_BUCKET', 4)
 
+# user-api responses keyed by base order number; cleared at the start of each invocation
+mlp_responses = {}
+mlp_lock = threading.Lock()
 
-failed = []
-rate_limited = []
-no_mlp_or_sprayer_data = []
-no_mlp_data = []
-no_rate = []
 
+def needs_mlp_lookup(order):
+    has_lawn_plan = any(isLawnPlan(item["sku"]) for item in order["items"])
+    return has_lawn_plan or int(order['orderNumber'].split("-")[0]) >= 10525
+
+
+def fetch_mlp_record(order_number):
+    fixture = dry_run.mlp_record(order_number) if dry_run is not None else None
+    if fixture is not None:
+        return fixture
+
+    with mlp_lock:
+        cached = mlp_responses.get(order_number)
+    if cached is not None:
+        return cached
+
+    # While the user-api is down, orders go ahead without MLP data instead of each waiting out the failure
+    breaker = circuit_breakers['mlp']
+    if not breaker.allow():
+        return (503, b'MLP circuit open', None)
+
+    url_mlp = f"{MLP_API_URL}/order?shopify_order_no={order_number}"
+    try:
+        with current_metrics.get().timer('StageLatency', 'Stage', 'mlp_fetch'), logged_attempts() as attempts:
+            response_mlp = send_with_retry(lambda: session.get(url_mlp, timeout=HTTP_TIMEOUTS['mlp']), 'mlp')
+            records = response_mlp.json() if response_mlp.status_code == 200 else None
+    except Exception:
+        breaker.record(False)
+        raise
+    # A 404, or a 200 with no records, is an order the user-api doesn't know, not an unhealthy upstream
+    breaker.record(response_mlp.status_code not in RETRYABLE_STATUS_CODES, attempts.slowest)
+    status_code = 404 if records == [] else response_mlp.status_code
+    result = (status_code, response_mlp.content, records[0] if records else None)
+
+    with mlp_lock:
+        mlp_responses[order_number] = result
+    return result
+
+
+@timed_stage('process_order')
 def processor(order):
     mlp_data = {}
     
     order_number = order['orderNumber']
 
-    sprayer_order = any(item['sku'] and item['sku'] not in config.non_sprayer_skus for item in order['items'])
+    sprayer_order = any(sku_info(item['sku']).sprayer_eligible for item in order['items'])
     
     has_lawn_plan = any(isLawnPlan(item["sku"]) for item in order["items"])
     
     if "-" in order_number:
         order_number = order_number.split("-")[0]
     
-    if not has_lawn_plan and int(order_number) < 10525:
-        process_order(order, mlp_data)
+    if not needs_mlp_lookup(order):
+        return process_order(order, mlp_data)
     else:
-        url_mlp = f"https://user-api-dev-qhw6i22s2q-uc.a.run.app/order?shopify_order_no={order_number}"
-        response_mlp = session.get(url_mlp)
+        status_code, content, data_mlp = fetch_mlp_record(order_number)
 
-        if response_mlp.status_code != 200:
-            no_mlp_or_sprayer_data.append(order_number)
+        if status_code != 200:
             if has_lawn_plan:
-                failed.append(order_number)
-            print(f"(Log for #{order_number}) Error retrieving order info for #{order_number} // Processing without MLP or sprayer info // Response status code: {response_mlp.status_code} // Response content: {response_mlp.content}", flush=True)
-            process_order(order, mlp_data)
+                # The shipment goes out without its plan products; a rerun can fix that if the outage was transient
+                current_ledger.get().fail(order_number, 'no_mlp_or_sprayer_data', retryable=status_code in RETRYABLE_STATUS_CODES)
+            else:
+                current_ledger.get().note(order_number, 'no_mlp_or_sprayer_data')
+            print(f"(Log for #{order_number}) Error retrieving order info for #{order_number} // Processing without MLP or sprayer info // Response status code: {status_code} // Response content: {content}", flush=True)
+            return process_order(order, mlp_data)
 
         else:
     
-            data_mlp = response_mlp.json()[0]
-            
             # Check for green_sprayers
             green_sprayers = int(data_mlp.get("green_sprayers", 0))
             if green_sprayers > 0 and sprayer_order:
@@ -86,8 +594,8 @@ def processor(order):
                                 total_products = 0
                                 for product in detail['products']:
                                     if 'Bundle' in product['name'] or 'Plan' in product['name']:
-                                        no_mlp_data.append(order_number)
-                                        print(f"(Log for #{order_number}) Error retrieving plan info for #{order_number} // Processing without MLP info // Response status code: {response_mlp.status_code} // Response content: {response_mlp.content}", flush=True)
+                                        current_ledger.get().note(order_number, 'no_mlp_data')
+                                        print(f"(Log for #{order_number}) Error retrieving plan info for #{order_number} // Processing without MLP info // Response status code: {status_code} // Response content: {content}", flush=True)
                                         return process_order(order, mlp_data)
                                     product['count'] = int(product['count'])
                                     total_products += product['count']
@@ -103,31 +611,116 @@ def processor(order):
                                 
                                 mlp_data[detail['sku']] = product_list
                                 break
-            process_order(order, mlp_data)
+            return process_order(order, mlp_data)
 
 
 
-def extract_data_from_resource_url(event, retries=3):
+def fetch_resource_page(resource_url, page, retries=3):
     for attempts in range(1, retries + 1):
         try:
-            payload = json.loads(event["body"])
-            resource_url = payload['resource_url']
-            print(f"Fetching data from resource_url: {resource_url}")
-            response = session.get(resource_url)
+            response = shipstation_request('GET', resource_url, params={'page': page})
             data = response.json()
-            orders = data['orders']
-            print(f"All orders: {orders}")
-            return orders
+            if 'orders' not in data:
+                raise KeyError('orders')
+            return data
         except Exception as e:
             if attempts < retries:
-                print(f"An error occurred: {str(e)}. Making another attempt...")
+                print(f"An error occurred fetching page {page}: {str(e)}. Making another attempt...")
             elif attempts == retries:
-                print(f"An error occurred: {str(e)}. Making final attempt...")
+                print(f"An error occurred fetching page {page}: {str(e)}. Giving up on remaining pages")
     return None  # If all attempts fail, return None
 
 
+# Yields processable orders page by page, so large imports aren't cut off after the first page
+def extract_data_from_resource_url(event):
+    payload = json.loads(event["body"])
+    resource_url = payload['resource_url']
+    print(f"Fetching data from resource_url: {resource_url}")
+
+    page = 1
+    pages = 1
+    while page <= pages:
+        data = fetch_resource_page(resource_url, page)
+        if data is None:
+            # Orders on this page and the ones after it were never seen
+            current_ledger.get().fetch_incomplete(page, pages)
+            return
+        pages = data.get('pages') or 1
+        print(f"Fetched page {page} of {pages} ({len(data['orders'])} orders)")
+        yield from filter(is_processable, data['orders'])
+        page += 1
+
+
+def is_processable(order):
+    return "-" not in order['orderNumber'] and order['orderStatus'] == 'awaiting_shipment'
+
+
+# Orders passed in the event itself, for dry runs and replays
+def extract_inline_orders(event):
+    orders = event['orders']
+    print(f"Using {len(orders)} orders passed in the event")
+    yield from filter(is_processable, orders)
+
+
+MOSQUITO_SKUS = {"OTP - MD", "OTP - MD-2", "OTP - MD-3", "SUB - MDA - D", "SUB - MDA - S", "SUB - MDA - G", "SUB - MD - D", "SUB - MD - S", "SUB - MD - G"}
+YELLOW_SPRAYER_SKUS = {'SUB - LG - D', 'SUB - LG - S', 'SUB - LG - G', 'OTP - WNF', "SUB - HERO - D", "1SUB - HERO - S", "2SUB - HERO - G"}
+PLAN_TAG_SKUS = ["MLP", "TLP", "SFLP", "OLFP", "Organic", "SELP", "GSLP", "AALP", "HERO"]
+
+
+# Everything the pipeline asks about a SKU, worked out once
+class SkuInfo:
+    __slots__ = ('sku', 'lawn_plan', 'plan_tagged', 'hero', 'mosquito', 'otp', 'amazon_otp', 'sprayer_eligible', 'yellow_sprayer',
+                 'lawn_guard', 'stk', 'lyl', 'pouches', 'pack_size', 'base_pouches', 'replacement_name', 'unit_weight', 'plan_tag_id')
+
+    def __init__(self, sku):
+        sku = sku or ''
+        self.sku = sku
+        self.lawn_plan = bool(sku) and (sku.startswith('SUB') or sku in ['05000', '10000', '15000']) and sku not in config.non_plan_subs
+        self.plan_tagged = any(plan_sku in sku for plan_sku in PLAN_TAG_SKUS)
+        self.hero = 'HERO' in sku
+        self.mosquito = sku in MOSQUITO_SKUS
+        self.otp = sku.startswith("OTP")
+        self.amazon_otp = sku in config.amazon_otp_skus
+        self.sprayer_eligible = bool(sku) and sku not in config.non_sprayer_skus
+        self.yellow_sprayer = sku in YELLOW_SPRAYER_SKUS
+        self.lawn_guard = 'LG' in sku
+        self.stk = 'STK' in sku
+        self.lyl = 'LYL' in sku
+        self.pouches = config.sku_to_pouches.get(sku, 0)
+        self.pack_size = config.sku_to_pouches.get(sku, 1)  # Unknown SKUs take a slot when packing
+        self.base_pouches = config.hero_base_pouches.get(sku)
+        self.replacement_name = config.SKU_REPLACEMENTS.get(sku)
+        self.unit_weight = config.product_weights.get(self.replacement_name)
+
+        if 'TLP' in sku:
+            self.plan_tag_id = 59793
+        elif 'SFLP' in sku:
+            self.plan_tag_id = 59794
+        elif 'OLFP' in sku or 'Organic' in sku:
+            self.plan_tag_id = 62745
+        else:
+            self.plan_tag_id = None
+
+
+def build_sku_catalog():
+    known_skus = set(config.sku_to_pouches) | set(config.SKU_REPLACEMENTS) | set(config.hero_base_pouches) | set(config.non_sprayer_skus)
+    known_skus |= set(config.amazon_otp_skus) | set(config.non_plan_subs) | MOSQUITO_SKUS | YELLOW_SPRAYER_SKUS
+    return {sku: SkuInfo(sku) for sku in known_skus}
+
+
+# Built at cold start; SKUs missing from config are classified on first sight and kept
+sku_catalog = build_sku_catalog()
+
+
+def sku_info(sku):
+    info = sku_catalog.get(sku)
+    if info is None:
+        info = sku_catalog[sku] = SkuInfo(sku)
+    return info
+
+
 def isLawnPlan(sku):
-    return (sku.startswith('SUB') or sku in ['05000', '10000', '15000']) and sku not in config.non_plan_subs
+    return sku_info(sku).lawn_plan
 
 
 def should_add_gnome_to_parent_order(parent_order):
@@ -158,10 +751,9 @@ def set_order_tags(order, parent_order, total_pouches):
     else:
         order['tagIds'] = []
 
-    lawn_plan_skus = ["MLP", "TLP", "SFLP", "OLFP", "Organic", "SELP", "GSLP", "AALP", "HERO"]
-    has_lawn_plan = any(any(plan_sku in item['sku'] for plan_sku in lawn_plan_skus) for item in order['items'])
+    has_lawn_plan = any(sku_info(item['sku']).plan_tagged for item in order['items'])
 
-    parent_has_lawn_plan = any(any(plan_sku in item['sku'] for plan_sku in lawn_plan_skus) for item in parent_order['items'])
+    parent_has_lawn_plan = any(sku_info(item['sku']).plan_tagged for item in parent_order['items'])
     parent_tags = parent_order['advancedOptions'].get('customField1', '') or '' 
     
     if 'Amazon' in parent_tags:
@@ -190,22 +782,19 @@ def set_order_tags(order, parent_order, total_pouches):
 
     otp_order_counter = 0
     for item in order['items']:
+        info = sku_info(item['sku'])
 
         # Checks for OTPs
-        if item['sku'].startswith("OTP"):
+        if info.otp:
             otp_order_counter += 1
             continue
-        if 63002 in order['tagIds'] and item['sku'] in config.amazon_otp_skus:
+        if 63002 in order['tagIds'] and info.amazon_otp:
             otp_order_counter += 1
             continue
 
-        if 'TLP' in item['sku']:
-            order['tagIds'].append(59793)
-            continue
-        if 'SFLP' in item['sku']:
-            order['tagIds'].append(59794)
-            continue
-        if 'OLFP' in item['sku'] or 'Organic' in item['sku'] or 'Organic Lawn' in item['name']:
+        if info.plan_tag_id:
+            order['tagIds'].append(info.plan_tag_id)
+        elif 'Organic Lawn' in item['name']:
             order['tagIds'].append(62745)
 
     if otp_order_counter == len(order['items']):
@@ -216,15 +805,86 @@ def set_order_tags(order, parent_order, total_pouches):
 
     return order
 
-def update_dict(original, updates):
-    for key, value in updates.items():
-        if isinstance(value, dict):
-            # Get the original value if it's a dictionary, otherwise create an empty dict
-            nested_original = original.get(key, {}) if isinstance(original.get(key), dict) else {}
-            original[key] = update_dict(nested_original, value)
-        else:
-            original[key] = value
-    return original
+NESTED = object()  # Marks a path in a compiled preset that must hold a dict
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(nested) for key, nested in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(nested) for nested in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(nested) for key, nested in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(nested) for nested in value]
+    return value
+
+
+# A preset flattened into (path, value) leaves; applying it copies only the dicts it writes to
+class PresetPatch:
+    __slots__ = ('leaves',)
+
+    def __init__(self, preset):
+        self.leaves = tuple(self.flatten(preset, ()))
+
+    @classmethod
+    def flatten(cls, preset, prefix):
+        for key, value in preset.items():
+            path = prefix + (key,)
+            if isinstance(value, dict):
+                yield path, NESTED
+                yield from cls.flatten(value, path)
+            else:
+                yield path, freeze(value)
+
+    def apply(self, order):
+        for path, value in self.leaves:
+            # Containers along the path were already copied by their own NESTED leaves
+            target = order
+            for key in path[:-1]:
+                target = target[key]
+            key = path[-1]
+            if value is NESTED:
+                target[key] = dict(target[key]) if isinstance(target.get(key), dict) else {}
+            else:
+                target[key] = thaw(value)
+        return order
+
+
+def compile_presets():
+    patches = {}
+    for use_stk_preset, preset_dict in ((False, config.presets), (True, config.presets_with_stk)):
+        for preset_key, preset in preset_dict.items():
+            patches[(preset_key, use_stk_preset)] = PresetPatch(preset)
+    return patches
+
+
+# Compiled at cold start, keyed by (pouch count, STK preset); mosquito-only and the special cases have their own patch
+PRESET_PATCHES = compile_presets()
+MOSQUITO_ONLY_PATCH = PresetPatch(config.mosquito_only_preset)
+STK_ONLY_PATCH = PresetPatch(config.stk_only)
+OTHER_USPS_PATCH = PresetPatch(config.other_usps_items)
+EMPTY_PATCH = PresetPatch({})
+
+
+def preset_patch(total_pouches, use_stk_preset, mosquito_only_order):
+    if mosquito_only_order:
+        return MOSQUITO_ONLY_PATCH
+    return PRESET_PATCHES.get((str(total_pouches), use_stk_preset), EMPTY_PATCH)
+
+
+# Shallow copy that shares nested data with the source; only the dicts edited in place are copied
+def derive_order(order, **overrides):
+    derived = dict(order)
+    for key in ('advancedOptions', 'weight', 'dimensions'):
+        if isinstance(derived.get(key), dict):
+            derived[key] = dict(derived[key])
+    derived.update(overrides)
+    return derived
 
 
 
@@ -246,8 +906,8 @@ def process_item(item, mlp_data):
             weight = 316.8
         else:
             weight = 312.48
-    elif original_sku in config.SKU_REPLACEMENTS:
-        if isLawnPlan(original_sku):
+    elif sku_info(original_sku).replacement_name:
+        if sku_info(original_sku).lawn_plan:
             for sku, products_info in mlp_data.items():
                 if sku == original_sku:
                     item['name'] = config.SKU_REPLACEMENTS[original_sku]
@@ -256,23 +916,19 @@ def process_item(item, mlp_data):
                         weight += config.product_weights[product_info['name']]*int(product_info['count'])
                     break
         else:
-            replacement_name = config.SKU_REPLACEMENTS[original_sku]
-            item["name"] = replacement_name
-            weight = config.product_weights[replacement_name] * item['quantity']
+            info = sku_info(original_sku)
+            item["name"] = info.replacement_name
+            weight = info.unit_weight * item['quantity']
     return (item, weight)
 
 
-def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = False, use_stk_preset=False):
+def apply_preset_based_on_pouches(order, mlp_data, total_pouches, to_rate_shop, is_parent = False, use_stk_preset=False):
     if len(order['items']) == 1 and use_stk_preset:
-        order = update_dict(order, config.stk_only)
-        return order
-
-    preset = {}
+        return STK_ONLY_PATCH.apply(order)
 
     order['weight']['value'] = 0
 
-    with ThreadPoolExecutor(max_workers=len(order['items'])) as executor:
-        processed_items = list(executor.map(lambda item: process_item(item, mlp_data), [item for item in order['items'] if item['sku']]))
+    processed_items = [process_item(item, mlp_data) for item in order['items'] if item['sku']]
 
     weight = sum([w for _, w in processed_items])
 
@@ -283,7 +939,7 @@ def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = Fa
         order['items'].append(item)
 
         # If the item sku contains 'HERO', add the relevant items from config
-        if 'HERO' in item['sku']:
+        if sku_info(item['sku']).hero:
             box = 'Box1'
             if '3 of' in item['name']:
                 box = 'Box3'
@@ -295,8 +951,9 @@ def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = Fa
                 else:
                     item['name'] = config.hero_giant[0]
             for hero_item in config.hero_bundle_items[item['sku']][box]:
+                hero_item = dict(hero_item)
                 # Apply additional logic if the item is a Lawn Plan
-                if isLawnPlan(hero_item['sku']):
+                if sku_info(hero_item['sku']).lawn_plan:
                     for sku, products_info in mlp_data.items():
                         if sku == item['sku']:
                             for product_info in products_info:
@@ -305,30 +962,13 @@ def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = Fa
                                     weight += config.product_weights[product_info['name']]*int(product_info['count'])
                 order['items'].append(hero_item)
     if total_pouches == 0:
-        order = update_dict(order, config.other_usps_items)
+        order = OTHER_USPS_PATCH.apply(order)
         order['weight']['value'] = weight
         return order
 
-    mosquito_skus = ["OTP - MD" , "OTP - MD-2" , "OTP - MD-3", "SUB - MDA - D", "SUB - MDA - S", "SUB - MDA - G", "SUB - MD - D", "SUB - MD - S", "SUB - MD - G",]
-
-    non_mosquito_items = [item for item in order['items'] if item['sku'] not in mosquito_skus]
+    mosquito_only_order = all(sku_info(item['sku']).mosquito for item in order['items'])
 
-    mosquito_only_order = len(non_mosquito_items) == 0
-
-    if mosquito_only_order:
-        preset = copy.deepcopy(config.mosquito_only_preset)
-
-    else:
-        preset_dict = config.presets_with_stk if use_stk_preset else config.presets
-        
-        
-        preset_key = str(total_pouches)
-        if preset_key in preset_dict:
-            preset = copy.deepcopy(preset_dict[preset_key])
-    
-    
-    updated_order = order.copy()
-    updated_order = update_dict(updated_order, preset)
+    updated_order = preset_patch(total_pouches, use_stk_preset, mosquito_only_order).apply(order.copy())
 
     # Add green sprayer to items
     if is_parent and 'OTP - HES - G' in mlp_data:
@@ -337,7 +977,7 @@ def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = Fa
         updated_order['items'].append(green_sprayers)
 
     # Add yellow sprayer to items
-    if 'OTP - HES - Y' in mlp_data and any('LG' in item['sku'] for item in updated_order['items']):
+    if 'OTP - HES - Y' in mlp_data and any(sku_info(item['sku']).lawn_guard for item in updated_order['items']):
         yellow_sprayers = config.yellow_sprayer.copy()
         yellow_sprayers['quantity'] = mlp_data['OTP - HES - Y'][0]['count']
         updated_order['items'].append(yellow_sprayers)
@@ -345,19 +985,43 @@ def apply_preset_based_on_pouches(order, mlp_data, total_pouches, is_parent = Fa
 
     updated_order['weight']['value'] += weight
 
-    if 'advancedOptions' in updated_order and 'advancedOptions' in preset:
-        updated_order['advancedOptions'] = update_dict(updated_order['advancedOptions'], preset['advancedOptions'])
-    elif 'advancedOptions' not in updated_order and 'advancedOptions' in preset:
-        updated_order['advancedOptions'] = preset['advancedOptions']
-    
-    rate_shop(updated_order)
+    # Quoted later together with the rest of the order's shipments
+    to_rate_shop.append(updated_order)
 
     return updated_order
 
 
 
-def get_ups_token():
-    oauth_url = "https://wwwcie.ups.com/security/v1/oauth/token"
+# OAuth token kept until shortly before expiry; concurrent callers share one refresh
+class TokenCache:
+    def __init__(self, fetch_token, refresh_margin=60):
+        self.fetch_token = fetch_token  # Returns (access_token, expires_in_seconds)
+        self.refresh_margin = refresh_margin
+        self.entry = (None, 0)
+        self.lock = threading.Lock()
+
+    def get(self):
+        token, expires_at = self.entry
+        if token and time.monotonic() < expires_at - self.refresh_margin:
+            return token
+
+        with self.lock:
+            # Another thread may have refreshed the token while we waited for the lock
+            token, expires_at = self.entry
+            if token and time.monotonic() < expires_at - self.refresh_margin:
+                return token
+
+            token, expires_in = self.fetch_token()
+            if token:
+                self.entry = (token, time.monotonic() + int(expires_in or 0))
+            return token
+
+    def invalidate(self):
+        self.entry = (None, 0)
+
+
+def fetch_ups_token():
+    oauth_url = f"{UPS_OAUTH_URL}/security/v1/oauth/token"
 
     payload = {
         "grant_type": "client_credentials"
@@ -367,20 +1031,27 @@ def get_ups_token():
         "Content-Type": "application/x-www-form-urlencoded"
     }
 
-    response = session.post(oauth_url, data=payload, headers=headers, auth=(config.UPS_CLIENT_ID, config.UPS_CLIENT_SECRET))
+    response = send_with_retry(lambda: session.post(oauth_url, data=payload, headers=headers, auth=(config.UPS_CLIENT_ID, config.UPS_CLIENT_SECRET), timeout=HTTP_TIMEOUTS['ups']), 'ups')
     if response.status_code != 200:
         print("Error occurred: ", response.text)  # Print the error message
         response.raise_for_status()  # This will raise an exception if the request failed
 
     data = response.json()
-    return data["access_token"]
+    return data["access_token"], data.get("expires_in")
+
+
+ups_token_cache = TokenCache(fetch_ups_token)
+
+
+def get_ups_token():
+    return ups_token_cache.get()
 
 def get_ups_rate(order):
-    rating_url = "https://onlinetools.ups.com/ship/v1/rating/Rate"
+    rating_url = f"{UPS_API_URL}/ship/v1/rating/Rate"
 
     headers = {
         "Content-Type": "application/json",
-        "transId": start_time.strftime('%m-%d-%Y_%H:%M'),
+        "transId": datetime.now(pacific_timezone()).strftime('%m-%d-%Y_%H:%M'),
         "transactionSrc": "GnomeHQ",
         "AccessLicenseNumber": config.UPS_ACCESS_KEY,
         "Username" : config.UPS_USERNAME,
@@ -444,7 +1115,7 @@ def get_ups_rate(order):
 
     # Try operation
     try:
-        response = session.post(rating_url, headers=headers, data=request_body)
+        response = send_with_retry(lambda: session.post(rating_url, headers=headers, data=request_body, timeout=HTTP_TIMEOUTS['ups']), 'ups')
         response.raise_for_status()  # check that the request was successful
 
         rate = response.json()['RateResponse']['RatedShipment']['NegotiatedRateCharges']['TotalCharge']['MonetaryValue']
@@ -457,8 +1128,8 @@ def get_ups_rate(order):
         return None
 
 
-def get_fedex_access_token():
-    url = "https://apis.fedex.com/oauth/token"
+def fetch_fedex_access_token():
+    url = f"{FEDEX_API_URL}/oauth/token"
 
     payload = {
         'grant_type': 'client_credentials',
@@ -470,21 +1141,25 @@ def get_fedex_access_token():
         'Content-Type': "application/x-www-form-urlencoded"
     }
 
-    response = requests.request("POST", url, data=payload, headers=headers)
+    response = send_with_retry(lambda: session.post(url, data=payload, headers=headers, timeout=HTTP_TIMEOUTS['fedex']), 'fedex')
 
     if response.status_code == 200:
         data = response.json()
-        return data['access_token']
+        return data['access_token'], data.get('expires_in')
     else:
         print("Failed to get FedEx access token")
-        return None
+        return None, None
+
 
+fedex_token_cache = TokenCache(fetch_fedex_access_token)
 
 
+def get_fedex_access_token():
+    return fedex_token_cache.get()
 
 
 def get_fedex_rate(order):
-    url = "https://apis.fedex.com/rate/v1/rates/quotes"
+    url = f"{FEDEX_API_URL}/rate/v1/rates/quotes"
 
     token = get_fedex_access_token()
 
@@ -527,8 +1202,13 @@ def get_fedex_rate(order):
             ]
         }
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    data = response.json()
+    response = send_with_retry(lambda: session.post(url, headers=headers, data=json.dumps(payload), timeout=HTTP_TIMEOUTS['fedex']), 'fedex')
+
+    # A cached token can be revoked before its advertised expiry; fetch a fresh one and retry once
+    if response.status_code == 401:
+        fedex_token_cache.invalidate()
+        headers['Authorization'] = f"Bearer {get_fedex_access_token()}"
+        response = send_with_retry(lambda: session.post(url, headers=headers, data=json.dumps(payload), timeout=HTTP_TIMEOUTS['fedex']), 'fedex')
 
     if response.status_code == 200:
         data = response.json()
@@ -541,12 +1221,12 @@ def get_fedex_rate(order):
         print(f"Error: Received status code {response.status_code} from FedEx API: {response.text}")
         rate = None
 
-    return float(rate)
+    return float(rate) if rate is not None else None
 
 
 
 def get_shipstation_ups_rate(order):
-    url = "https://ssapi.shipstation.com/shipments/getrates"
+    url = f"{SHIPSTATION_API_URL}/shipments/getrates"
 
     payload = {
         "carrierCode": 'ups_walleted',
@@ -572,11 +1252,10 @@ def get_shipstation_ups_rate(order):
         "X-Partner": config.x_partner
     }
 
-    response = session.post(url, headers=headers, data=json.dumps(payload))
+    response = shipstation_request('POST', url, headers=headers, data=json.dumps(payload), timeout=HTTP_TIMEOUTS['shipstation_rates'])
     if response.status_code != 200:
-        if response.status_code == 429:
-                rate_limited.append(order)
-        failed.append(order['orderNumber'])
+        # One carrier missing a quote doesn't fail the order; the other carriers can still price it
+        current_ledger.get().note(order['orderNumber'], 'shipstation_ups_rate_limited' if response.status_code == 429 else 'shipstation_ups_rate_failed')
         print(f"(Log for #{order['orderNumber']}): Failed to get Shipstation UPS rate")
         return None
     rates = response.json()
@@ -585,7 +1264,7 @@ def get_shipstation_ups_rate(order):
 
 
 def get_shipstation_usps_rate(order):
-    url = "https://ssapi.shipstation.com/shipments/getrates"
+    url = f"{SHIPSTATION_API_URL}/shipments/getrates"
 
     payload = {
         "carrierCode": 'stamps_com',
@@ -611,41 +1290,277 @@ def get_shipstation_usps_rate(order):
         "X-Partner": config.x_partner
     }
 
-    response = session.post(url, headers=headers, data=json.dumps(payload))
+    response = shipstation_request('POST', url, headers=headers, data=json.dumps(payload), timeout=HTTP_TIMEOUTS['shipstation_rates'])
     rates = response.json()
 
     return rates[0]['shipmentCost'] + rates[0]['otherCost']
 
-def rate_helper(rate_function, order):
+# LRU cache of carrier quotes with a TTL
+class RateCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, rate):
+        with self.lock:
+            self.entries[key] = (rate, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+rate_cache = RateCache(RATE_CACHE_TTL, RATE_CACHE_MAX_ENTRIES)
+
+
+# Learned quotes per carrier, destination ZIP3 and whole-pound weight break. Used to skip carriers that are
+# clearly not the cheapest and to price carriers that couldn't answer in time. Estimates older than
+# RATE_TABLE_MAX_AGE seconds are ignored, so skipped carriers get quoted (and re-learned) again.
+# RATE_TABLE_PATH persists the table to a file. Lambda's /tmp belongs to a single execution environment and lives no
+# longer than the module-level table itself, so only a shared mount (EFS) lets new containers start warm; unset by default.
+RATE_TABLE_PATH = getattr(config, 'RATE_TABLE_PATH', None)
+RATE_TABLE_MAX_AGE = getattr(config, 'RATE_TABLE_MAX_AGE', 86400)
+RATE_TABLE_SMOOTHING = getattr(config, 'RATE_TABLE_SMOOTHING', 0.3)
+# Carriers with an estimate that are still quoted live for each shipment; 0 quotes every carrier
+RATE_SHOP_CANDIDATES = getattr(config, 'RATE_SHOP_CANDIDATES', 2)
+
+
+# Smoothed quotes keyed by carrier, service, ZIP3, residential flag and weight break
+class RateTable:
+    def __init__(self, path, max_age, smoothing):
+        self.path = path
+        self.max_age = max_age
+        self.smoothing = smoothing
+        self.entries = None  # key -> [rate, observed at (epoch seconds)]; loaded on first use
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(order, carrier_code, service_code):
+        weight_break = max(math.ceil(order['weight']['value'] / 16), 1)
+        return f"{carrier_code}|{service_code}|{str(order['shipTo']['postalCode'])[:3]}|{int(bool(order['shipTo']['residential']))}|{weight_break}"
+
+    def load(self):
+        # Callers hold self.lock
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if not self.path:
+            return
+        try:
+            with open(self.path) as table:
+                self.entries = json.load(table)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Unable to load rate table from {self.path}: {e}", flush=True)
+
+    def estimate(self, order, carrier_code, service_code):
+        key = self.key(order, carrier_code, service_code)
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            return None
+        return entry[0]
+
+    def observe(self, order, carrier_code, service_code, rate):
+        key = self.key(order, carrier_code, service_code)
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] <= self.max_age:
+                rate = round(entry[0] + self.smoothing * (rate - entry[0]), 2)
+            self.entries[key] = [rate, time.time()]
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            entries = dict(self.entries)
+            self.dirty = False
+        try:
+            # Written beside the target and swapped in, so a concurrent load never sees half a file
+            temporary_path = f"{self.path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, 'w') as table:
+                json.dump(entries, table)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Unable to save rate table to {self.path}: {e}", flush=True)
+
+
+rate_table = RateTable(RATE_TABLE_PATH, RATE_TABLE_MAX_AGE, RATE_TABLE_SMOOTHING)
+
+
+def rate_cache_key(order, carrier_code, service_code):
+    dimensions = order.get('dimensions') or {}
+    weight_bucket = math.ceil(order['weight']['value'] / RATE_CACHE_WEIGHT_BUCKET)
+    return (
+        carrier_code,
+        service_code,
+        str(order['shipTo']['postalCode'])[:5],
+        bool(order['shipTo']['residential']),
+        dimensions.get('length'),
+        dimensions.get('width'),
+        dimensions.get('height'),
+        weight_bucket
+    )
+
+
+def rate_helper(rate_function, order, carrier_code, service_code, deadline=None):
+    if dry_run is not None:
+        return dry_run.quote(order, carrier_code, service_code)
+
+    key = rate_cache_key(order, carrier_code, service_code)
+    rate = rate_cache.get(key)
+    if rate is not None:
+        current_metrics.get().record('RateCacheHits', 1, 'Count')
+        return rate
+    current_metrics.get().record('RateCacheMisses', 1, 'Count')
+
+    # A carrier whose circuit is open is left out of rate shopping rather than waited on
+    breaker = circuit_breakers[CARRIER_CIRCUITS[carrier_code]]
+    if not breaker.allow():
+        raise RateUnavailable(f"{carrier_code} circuit open")
+
+    token = call_deadline.set(deadline)
     try:
-        return rate_function(order)
+        with current_metrics.get().timer('CarrierLatency', 'Carrier', carrier_code), logged_attempts() as attempts:
+            rate = rate_function(order)
+    except PacerExhausted as e:
+        # Our own request budget, not the carrier, kept this quote from going out; the breaker doesn't hear of it
+        current_metrics.get().record('QuotesPaced', 1, 'Count', 'Carrier', carrier_code)
+        raise RatePaced(f"{carrier_code} quote paced") from e
     except Exception as e:
+        # A carrier that answers, even to reject the shipment, is up; only transient failures count against it
+        breaker.record(not attempts.ended_transiently(), attempts.slowest)
         print(f"(Log for #{order['orderNumber']}) Error fetching rate using function '{rate_function.__name__}': {e}")
+        if attempts.ended_transiently():
+            raise RateUnavailable(f"{carrier_code} unavailable") from e
         return None
+    finally:
+        call_deadline.reset(token)
+    breaker.record(not attempts.ended_transiently(), attempts.slowest)
+    if rate is None and attempts.ended_transiently():
+        raise RateUnavailable(f"{carrier_code} unavailable (status {attempts.last_status})")
 
+    if rate is not None:
+        rate_cache.set(key, rate)
+        rate_table.observe(order, carrier_code, service_code, rate)
+    return rate
 
-def rate_shop(order):
+
+def carrier_options(order):
     fedex_service = 'fedex_home_delivery' if order['shipTo']['residential'] else 'fedex_ground'
 
-    carrier_codes = ['fedex', 'ups_walleted', 'ups', 'stamps_com']
-    service_codes = [fedex_service, 'ups_ground', 'ups_ground', 'usps_ground_advantage']
-    bill_to_accounts = [990329, 326495, 647173, 326494]
+    return [
+        ('fedex', fedex_service, 990329, get_fedex_rate),
+        ('ups_walleted', 'ups_ground', 326495, get_shipstation_ups_rate),
+        ('ups', 'ups_ground', 647173, get_ups_rate),
+        ('stamps_com', 'usps_ground_advantage', 326494, get_shipstation_usps_rate),
+    ]
+
+
+# carrier_options without carriers the rate table expects to lose to RATE_SHOP_CANDIDATES others
+def quote_options(order):
+    options = carrier_options(order)
+    # A dry run quotes from its own fixtures, so the live rate table mustn't decide which carriers it sees
+    if not RATE_SHOP_CANDIDATES or dry_run is not None:
+        return options
+
+    estimates = {carrier_code: rate_table.estimate(order, carrier_code, service_code) for carrier_code, service_code, _, _ in options}
+    known = sorted((estimate, carrier_code) for carrier_code, estimate in estimates.items() if estimate is not None)
+    # Carriers without a recent estimate are always quoted, so the table keeps learning them
+    keep = {carrier_code for _, carrier_code in known[:RATE_SHOP_CANDIDATES]}
+    keep.update(carrier_code for carrier_code, estimate in estimates.items() if estimate is None)
+
+    if len(keep) < len(options):
+        current_metrics.get().record('CarriersPruned', len(options) - len(keep), 'Count')
+    return [option for option in options if option[0] in keep]
+
+
+# Taken before each quote is sent and given back when it finishes, whether or not anyone still waits for it
+quote_slots = threading.BoundedSemaphore(RATE_SHOP_MAX_IN_FLIGHT)
+
+
+# Returns (future, carrier code, service code, account, deadline) per carrier option
+def dispatch_quotes(order, options, order_number=None):
+    quotes = []
+    shipment_deadline = time.monotonic() + RATE_SHOP_TIMEOUT
+    for carrier_code, service_code, account, rate_function in options:
+        if not quote_slots.acquire(timeout=max(shipment_deadline - time.monotonic(), 0)):
+            # Never sent: the shipment ran out of time waiting for a free slot, which counts as this carrier timing out
+            future = Future()
+            future.set_exception(FutureTimeoutError())
+            quotes.append((future, carrier_code, service_code, account, shipment_deadline))
+            continue
+        deadline = min(time.monotonic() + RATE_SHOP_CARRIER_TIMEOUTS.get(carrier_code, RATE_SHOP_TIMEOUT), shipment_deadline)
+        try:
+            future = submit_io(rate_helper, rate_function, order, carrier_code, service_code, deadline, order_number=order_number)
+        except Exception:
+            quote_slots.release()
+            raise
+        future.add_done_callback(lambda _: quote_slots.release())
+        quotes.append((future, carrier_code, service_code, account, deadline))
+    return quotes
+
+
+@timed_stage('rate_shop')
+def rate_shop(orders):
+    # Quote every carrier for every shipment, RATE_SHOP_MAX_IN_FLIGHT at a time; quotes that miss their deadline are
+    # left running and ignored. Shipments that would send identical quote requests share one set of quotes.
+    quotes = {}
+    keys = []
+    for order in orders:
+        options = quote_options(order)
+        key = tuple(rate_cache_key(order, carrier_code, service_code) for carrier_code, service_code, _, _ in options)
+        keys.append(key)
+        if key in quotes:
+            current_metrics.get().record('RateQuotesShared', 1, 'Count')
+            continue
+        quotes[key] = dispatch_quotes(order, options, order_number=order['orderNumber'])
+    for order, key in zip(orders, keys):
+        apply_cheapest_rate(order, quotes[key])
+
 
+def cheapest_quote(quotes, order):
     cheapest_rate = None
     cheapest_carrier = None
     cheapest_service = None
     cheapest_account = None
+    cheapest_estimated = False
+    timed_out = []
+    paced = []
 
-    for carrier_code, service_code, account in zip(carrier_codes, service_codes, bill_to_accounts):
-        # Get rate based on carrier
-        if carrier_code == 'fedex':
-            rate = rate_helper(get_fedex_rate, order)
-        elif carrier_code == 'ups_walleted':
-            rate = rate_helper(get_shipstation_ups_rate, order)
-        elif carrier_code == 'ups':
-            rate = rate_helper(get_ups_rate, order)
-        else:
-            rate = rate_helper(get_shipstation_usps_rate, order)
+    for future, carrier_code, service_code, account, deadline in quotes:
+        estimated = False
+        try:
+            rate = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except (FutureTimeoutError, RateUnavailable) as e:
+            if isinstance(e, FutureTimeoutError):
+                timed_out.append(carrier_code)
+            elif isinstance(e, RatePaced):
+                paced.append(carrier_code)
+            # A carrier that was slow, throttled or behind an open circuit is priced from the rate table instead.
+            # One that answered without a rate (it refused the shipment) is left out
+            rate = rate_table.estimate(order, carrier_code, service_code)
+            estimated = True
 
         # Check if the rate is the cheapest so far
         if rate is not None and (cheapest_rate is None or rate < cheapest_rate):
@@ -653,27 +1568,316 @@ def rate_shop(order):
             cheapest_carrier = carrier_code
             cheapest_service = service_code
             cheapest_account = account
+            cheapest_estimated = estimated
+
+    return cheapest_rate, cheapest_carrier, cheapest_service, cheapest_account, timed_out, paced, cheapest_estimated
+
+
+def apply_cheapest_rate(order, quotes):
+    cheapest_rate, cheapest_carrier, cheapest_service, cheapest_account, timed_out, paced, estimated = cheapest_quote(quotes, order)
+
+    if timed_out:
+        current_ledger.get().note(order['orderNumber'], 'rate_timeout')
+        print(f"(Log for #{order['orderNumber']}) Rate quotes timed out for carriers: {timed_out}")
+    if paced:
+        current_ledger.get().note(order['orderNumber'], 'rate_paced')
+        print(f"(Log for #{order['orderNumber']}) No ShipStation request budget left before the deadline for carriers: {paced}")
+    if estimated and cheapest_carrier:
+        current_ledger.get().note(order['orderNumber'], 'rate_estimated')
+        current_metrics.get().record('RatesEstimated', 1, 'Count')
+        print(f"(Log for #{order['orderNumber']}) No live quote from {cheapest_carrier}; chose it from the rate table estimate of {cheapest_rate}")
 
     if cheapest_rate and cheapest_carrier and cheapest_service and cheapest_account:
         order['carrierCode'] = cheapest_carrier
         order['serviceCode'] = cheapest_service
         order['advancedOptions']['billToMyOtherAccount'] = cheapest_account
     else:
-        no_rate.append(updated_order['orderNumber'])
+        current_ledger.get().note(order['orderNumber'], 'no_rate')
         print(f"(Log for #{order['orderNumber']}) Error, unable to retrieve shipping rates")
 
 
-def submit_order(order):
-    response = session.post('https://ssapi.shipstation.com/orders/createorder', data=json.dumps(order))
-    return response
+# ShipStation accepts at most 100 orders per createorders call
+SUBMIT_BATCH_SIZE = getattr(config, 'SUBMIT_BATCH_SIZE', 100)
+
+# Orders waiting for the next bulk call; cleared at the start of each invocation
+pending_submissions = []
+submission_lock = threading.Lock()
+
+
+@timed_stage('submit', per_order=False)
+def submit_orders(orders):
+    if dry_run is not None:
+        return dry_run.submit(orders)
+
+    order_numbers = [order['orderNumber'] for order in orders]
+    try:
+        response = shipstation_request('POST', f"{SHIPSTATION_API_URL}/orders/createorders", data=json.dumps(orders))
+        results = response.json().get('results', []) if response.status_code == 200 else None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # Only this batch is lost; the rest of the invocation's batches still go out
+        for order_number in order_numbers:
+            current_ledger.get().fail(order_number, 'submit_failed', retryable=True)
+        print(f"Error submitting orders {order_numbers}: {e!r}", flush=True)
+        return
+
+    if results is None:
+        for order_number in order_numbers:
+            current_ledger.get().fail(order_number, 'rate_limited' if response.status_code == 429 else 'submit_failed',
+                        retryable=response.status_code in RETRYABLE_STATUS_CODES)
+        print(f"Unexpected status code submitting orders {order_numbers}: {response.status_code}", flush=True)
+        print(f"Full error response: {response.__dict__}", flush=True)
+        return
+
+    results_by_number = {result.get('orderNumber'): result for result in results}
+    for order_processed in order_numbers:
+        result = results_by_number.get(order_processed)
+        if result and result.get('success'):
+            current_ledger.get().submitted(order_processed, result.get('orderId'))
+            print(f"(Log for #{order_processed}) Order #{order_processed} created successfully // Order ID: {result.get('orderId')}", flush=True)
+        else:
+            current_ledger.get().fail(order_processed, 'rejected')
+            error = result.get('errorMessage') if result else 'No result returned for order'
+            print(f"(Log for #{order_processed}) Failed to create order #{order_processed}: {error}", flush=True)
+
+
+def queue_submission(order):
+    # Orders are sent in bulk; a full batch is flushed right away so submission overlaps processing
+    with submission_lock:
+        pending_submissions.append(order)
+        if len(pending_submissions) < SUBMIT_BATCH_SIZE:
+            return
+        batch = pending_submissions[:SUBMIT_BATCH_SIZE]
+        del pending_submissions[:SUBMIT_BATCH_SIZE]
+    submit_orders(batch)
+
+
+def flush_submissions():
+    while True:
+        with submission_lock:
+            batch = pending_submissions[:SUBMIT_BATCH_SIZE]
+            del pending_submissions[:SUBMIT_BATCH_SIZE]
+        if not batch:
+            return
+        submit_orders(batch)
+
+
+def discard_submissions(plans):
+    # Withdraws the queued shipments of plans whose execution failed partway
+    shipment_numbers = {shipment['order']['orderNumber'] for plan in plans for shipment in plan['shipments']}
+    with submission_lock:
+        pending_submissions[:] = [order for order in pending_submissions if order['orderNumber'] not in shipment_numbers]
+
+
+# Orders already submitted (or being submitted by an overlapping invocation) are skipped before any network work.
+# Off unless configured. Deployments use 'dynamodb', the only store every container shares; 'sqlite' keeps the store
+# in a file under the container's own /tmp, so it only catches repeats within one container (and local runs).
+IDEMPOTENCY_STORE = getattr(config, 'IDEMPOTENCY_STORE', None)
+IDEMPOTENCY_DB_PATH = getattr(config, 'IDEMPOTENCY_DB_PATH', '/tmp/order_processor_idempotency.sqlite3')
+IDEMPOTENCY_TABLE = getattr(config, 'IDEMPOTENCY_TABLE', 'order-processor-idempotency')
+# Seconds a claim blocks other invocations before it is considered abandoned
+IDEMPOTENCY_LEASE = getattr(config, 'IDEMPOTENCY_LEASE', 900)
+
+
+def idempotency_key(order):
+    return order.get('orderKey') or order['orderNumber']
+
+
+def order_digest(order):
+    # Only fields that change what gets shipped; an edited order hashes differently and is processed again
+    content = {
+        'items': sorted((item['sku'], item['quantity']) for item in order['items']),
+        'weight': order.get('weight'),
+        'dimensions': order.get('dimensions'),
+        'carrierCode': order.get('carrierCode'),
+        'serviceCode': order.get('serviceCode'),
+        'postalCode': order.get('shipTo', {}).get('postalCode')
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Local SQLite file; each Lambda container has its own, so only for local runs
+class SqliteIdempotencyStore:
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS submissions (key TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+                               "status TEXT NOT NULL, lease_expires REAL NOT NULL)")
+
+    def connect(self):
+        # Imported here so invocations with the store disabled never load sqlite3. A connection per call
+        # keeps the store safe to use from any worker thread
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def claim(self, key, digest):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT digest, status, lease_expires FROM submissions WHERE key = ?", (key,)).fetchone()
+                if row and row[0] == digest and (row[1] == 'done' or row[2] > now):
+                    return False
+                connection.execute("INSERT OR REPLACE INTO submissions VALUES (?, ?, 'in_progress', ?)", (key, digest, now + IDEMPOTENCY_LEASE))
+            finally:
+                connection.execute("COMMIT")
+        return True
+
+    def complete(self, key, digest):
+        with self.connect() as connection:
+            connection.execute("UPDATE submissions SET status = 'done' WHERE key = ? AND digest = ?", (key, digest))
+
+    def release(self, key, digest):
+        with self.connect() as connection:
+            connection.execute("DELETE FROM submissions WHERE key = ? AND digest = ? AND status = 'in_progress'", (key, digest))
+
+
+# DynamoDB table keyed on 'key', shared by every container
+class DynamoIdempotencyStore:
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+        self.conditional_check_failed = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def claim(self, key, digest):
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={'key': key, 'digest': digest, 'status': 'in_progress', 'lease_expires': now + IDEMPOTENCY_LEASE},
+                ConditionExpression="attribute_not_exists(#key) OR digest <> :digest OR (#status = :in_progress AND lease_expires < :now)",
+                ExpressionAttributeNames={'#key': 'key', '#status': 'status'},
+                ExpressionAttributeValues={':digest': digest, ':in_progress': 'in_progress', ':now': now}
+            )
+        except self.conditional_check_failed:
+            return False
+        return True
+
+    def complete(self, key, digest):
+        self.table.update_item(
+            Key={'key': key},
+            UpdateExpression="SET #status = :done",
+            ConditionExpression="digest = :digest",
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':done': 'done', ':digest': digest}
+        )
+
+    def release(self, key, digest):
+        try:
+            self.table.delete_item(
+                Key={'key': key},
+                ConditionExpression="digest = :digest AND #status = :in_progress",
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':digest': digest, ':in_progress': 'in_progress'}
+            )
+        except self.conditional_check_failed:
+            pass
+
+
+IDEMPOTENCY_STORES = {
+    'sqlite': lambda: SqliteIdempotencyStore(IDEMPOTENCY_DB_PATH),
+    'dynamodb': lambda: DynamoIdempotencyStore(IDEMPOTENCY_TABLE)
+}
+
+idempotency_store = None
+idempotency_lock = threading.Lock()
+
+
+def get_idempotency_store():
+    # Built on first use so cold starts don't pay for a backend the invocation never touches
+    global idempotency_store
+    # Dry runs neither skip orders that were already submitted nor mark their own as done
+    if dry_run is not None:
+        return None
+    with idempotency_lock:
+        if idempotency_store is None and IDEMPOTENCY_STORE:
+            idempotency_store = IDEMPOTENCY_STORES[IDEMPOTENCY_STORE]()
+        return idempotency_store
+
+
+# Returns the order's (key, digest) claim, or None if it was already submitted or is in flight elsewhere
+def claim_order(order):
+    claim = (idempotency_key(order), order_digest(order))
+    try:
+        store = get_idempotency_store()
+        if store is None or store.claim(*claim):
+            return claim
+    except Exception as e:
+        # A store outage shouldn't hold up shipping; the worst case is the duplicate work we had before
+        print(f"(Log for #{order['orderNumber']}) Idempotency check failed, processing anyway: {e}", flush=True)
+        return claim
+
+    current_ledger.get().skipped(order['orderNumber'], 'duplicate')
+    print(f"(Log for #{order['orderNumber']}) Order already processed; skipping", flush=True)
+    return None
+
+
+def finish_order(order_number, claim):
+    # Marks the order done once every shipment made from it was created; otherwise frees it for the next webhook
+    statuses = [entry['status'] for entry in current_ledger.get().shipments(order_number)]
+    submitted = 'submitted' in statuses and 'failed' not in statuses
+    try:
+        store = get_idempotency_store()
+        if store is None:
+            return
+        if submitted:
+            store.complete(*claim)
+        else:
+            store.release(*claim)
+    except Exception as e:
+        print(f"(Log for #{order_number}) Unable to update idempotency record: {e}", flush=True)
+
+
+# Quotes used by dry runs that bring no rate fixtures: carrier code -> (base charge, charge per pound).
+# Placeholder figures for exercising the pipeline, not real tariffs.
+DRY_RUN_RATE_TABLE = getattr(config, 'DRY_RUN_RATE_TABLE', {
+    'fedex': (8.5, 0.9),
+    'ups_walleted': (9.0, 0.8),
+    'ups': (8.75, 0.85),
+    'stamps_com': (7.25, 1.1)
+})
+
+
+# Stand-ins for quotes, MLP lookups and submissions in a dry run; payloads collects what would be sent
+class DryRun:
+    def __init__(self, rates=None, mlp=None):
+        self.rates = rates
+        self.mlp = mlp or {}
+        self.payloads = []
+        self.lock = threading.Lock()
+
+    def quote(self, order, carrier_code, service_code):
+        if self.rates is not None:
+            return self.rates.get(carrier_code)
+        # What live quotes have taught the rate table beats the placeholder figures
+        estimate = rate_table.estimate(order, carrier_code, service_code)
+        if estimate is not None:
+            return estimate
+        base, per_pound = DRY_RUN_RATE_TABLE[carrier_code]
+        return round(base + per_pound * order['weight']['value'] / 16, 2)
+
+    def mlp_record(self, order_number):
+        record = self.mlp.get(order_number)
+        return None if record is None else (200, json.dumps([record]).encode('utf-8'), record)
+
+    def submit(self, orders):
+        with self.lock:
+            self.payloads.extend(orders)
+        for order in orders:
+            current_ledger.get().submitted(order['orderNumber'], None)
+            print(f"(Log for #{order['orderNumber']}) Dry run: order #{order['orderNumber']} not sent to ShipStation", flush=True)
+
+
+# Set by lambda_handler for dry-run invocations, None otherwise
+dry_run = None
+
 
 def total_pouches(order, initial_check=False):
     total_pouches = 0
     for item in order['items']:
-        if 'HERO' in item['sku'] and initial_check and "-" not in order['orderNumber']:
-            total_pouches += item['quantity'] * config.hero_base_pouches.get(item['sku'])
+        info = sku_info(item['sku'])
+        if info.hero and initial_check and "-" not in order['orderNumber']:
+            total_pouches += item['quantity'] * info.base_pouches
         else:
-            total_pouches += item['quantity'] * config.sku_to_pouches.get(item['sku'], 0)
+            total_pouches += item['quantity'] * info.pouches
     return total_pouches
 
 
@@ -688,83 +1892,214 @@ def process_order(order, mlp_data):
 
     if "-" not in order['orderNumber'] and parent_pouches > 10:
         # Prepare the child orders and parent order
-        original_order, child_orders = prepare_split_data(order, mlp_data, need_gnome)
-
-        # Execute POST requests for child and parent orders in parallel
-        orders_to_process = [original_order] + child_orders
-        with ThreadPoolExecutor(max_workers=len(orders_to_process)) as executor:
-            responses = list(executor.map(submit_order, orders_to_process))
-
-        # Check responses for successful order creation
-        for i, response in enumerate(responses):
-            order_processed = orders_to_process[i]['orderNumber']
-            if response.status_code == 200:
-                print(f"(Log for #{order_processed}) Order #{order_processed} created successfully", flush=True)
-                print(f"(Log for #{order_processed}) Full success response: {response.__dict__}", flush=True)
-            else:
-                if response.status_code == 429:
-                    rate_limited.append(order)
-                failed.append(order_processed)
-                print(f"(Log for #{order_processed}) Unexpected status code for order #{order_processed}: {response.status_code}", flush=True)
-                print(f"(Log for #{order_processed}) Full error response: {response.__dict__}", flush=True)
-        print(f"(Log for #{order['orderNumber']}) Successfully split and processed order #{order['orderNumber']}", flush=True)
-        return
+        original_order, child_orders, to_rate_shop = prepare_split_data(order, mlp_data, need_gnome)
+        return shipment_plan(order['orderNumber'], [original_order] + child_orders, to_rate_shop, split=True)
 
     else:
-        if any('HERO' in item['sku'] for item in order['items']):
+        if any(sku_info(item['sku']).hero for item in order['items']):
             order['items'].append(config.golden_gnome)
         elif need_gnome:
             gnome_item = config.gnome
             order['items'].append(gnome_item)
-        if any('STK' in item['sku'] or 'LYL' in item['sku'] for item in order['items']):
-            order = apply_preset_based_on_pouches(order, mlp_data, parent_pouches, is_parent, True)
+        to_rate_shop = []
+        if any(sku_info(item['sku']).stk or sku_info(item['sku']).lyl for item in order['items']):
+            order = apply_preset_based_on_pouches(order, mlp_data, parent_pouches, to_rate_shop, is_parent, True)
         else:
-            order = apply_preset_based_on_pouches(order, mlp_data, parent_pouches, is_parent)
-        copied_order = copy.deepcopy(order)
+            order = apply_preset_based_on_pouches(order, mlp_data, parent_pouches, to_rate_shop, is_parent)
+        # set_order_tags clears the tags it reads from the parent, so it needs a snapshot of the original
+        copied_order = derive_order(order)
         order = set_order_tags(order, copied_order, parent_pouches)
-        response = submit_order(order)
+        return shipment_plan(order['orderNumber'], [order], to_rate_shop, split=False)
+
+
+# Everything to create for one incoming order, as plain data
+def shipment_plan(order_number, shipments, to_rate_shop, split):
+    rate_shopped = {id(shipment) for shipment in to_rate_shop}
+    return {
+        'orderNumber': order_number,
+        'split': split,
+        'shipments': [{'order': shipment, 'rateShop': id(shipment) in rate_shopped} for shipment in shipments]
+    }
+
 
-        if response.status_code == 200:
-            print(f"(Log for #{order['orderNumber']}) Successfully processed order #{order['orderNumber']} without splitting", flush=True)
-            print(f"(Log for #{order['orderNumber']}) Full success response: {response.__dict__}", flush=True)
+@timed_stage('execute', per_order=False)
+# Rates and queues a batch of plans, quoting each distinct shipment once
+def execute_plans(plans):
+    # Work here is shared by the whole batch, not the order whose task happened to start it
+    current_order.set(None)
+
+    rate_shop([shipment['order'] for plan in plans for shipment in plan['shipments'] if shipment['rateShop']])
+
+    for plan in plans:
+        order_number = plan['orderNumber']
+        shipments = [shipment['order'] for shipment in plan['shipments']]
+        for shipment in shipments:
+            queue_submission(shipment)
+        if plan['split']:
+            print(f"(Log for #{order_number}) Parent order for {order_number}: {shipments[0]}", flush=True)
+            print(f"(Log for #{order_number}) Child orders for {order_number}: {shipments[1:]}", flush=True)
+            print(f"(Log for #{order_number}) Split order #{order_number} into {len(shipments)} shipments; queued for submission", flush=True)
         else:
-            failed.append(order['orderNumber'])
-            if response.status_code == 429:
-                rate_limited.append(order['orderNumber'])
-            print(f"(Log for #{order['orderNumber']}) Unexpected status code for order #{order['orderNumber']}: {response.status_code}", flush=True)
-            print(f"(Log for #{order['orderNumber']}) Full error response: {response.__dict__}", flush=True)
-        return
+            print(f"(Log for #{order_number}) Processed order #{order_number} without splitting; queued for submission", flush=True)
+
+
+# 'ffd' reproduces the packing orders have always shipped with. 'exact' searches for fewer boxes than first-fit on
+# small orders (and otherwise keeps the first-fit packing), but changes which items end up in each shipment
+PACKING_STRATEGY = getattr(config, 'PACKING_STRATEGY', 'ffd')
+EXACT_PACKING_MAX_UNITS = getattr(config, 'EXACT_PACKING_MAX_UNITS', 40)
+EXACT_PACKING_MAX_NODES = getattr(config, 'EXACT_PACKING_MAX_NODES', 20000)
+
+
+def pouch_size(sku):
+    return sku_info(sku).pack_size
+
+
+def units_that_fit(space, size, quantity):
+    if size <= 0:
+        return quantity if space >= 0 else 0
+    return min(quantity, max(space, 0) // size)
+
+
+# Bins being filled, with each bin's remaining pouch capacity
+class Packing:
+    __slots__ = ('capacity', 'first_bin_capacity', 'contents', 'space')
+
+    def __init__(self, capacity, first_bin_capacity, existing_bins=()):
+        self.capacity = capacity
+        self.first_bin_capacity = first_bin_capacity
+        self.contents = []
+        self.space = []
+        for bin in existing_bins:
+            index = self.open_bin()
+            for sku, count in bin:
+                self.add(index, sku, count)
+
+    def open_bin(self):
+        self.contents.append({})
+        self.space.append(self.first_bin_capacity if not self.space else self.capacity)
+        return len(self.space) - 1
+
+    def add(self, index, sku, count):
+        self.contents[index][sku] = self.contents[index].get(sku, 0) + count
+        self.space[index] -= pouch_size(sku) * count
+
+    def clone(self):
+        packing = Packing(self.capacity, self.first_bin_capacity)
+        packing.contents = [dict(contents) for contents in self.contents]
+        packing.space = list(self.space)
+        return packing
+
+    def to_bins(self):
+        return [list(contents.items()) for contents in self.contents]
+
+
+def fill_new_bins(packing, sku, size, quantity):
+    while quantity > 0:
+        index = packing.open_bin()
+        # A unit larger than a whole bin still gets a bin of its own
+        fit = max(units_that_fit(packing.space[index], size, quantity), 1)
+        packing.add(index, sku, fit)
+        quantity -= fit
+
+
+def first_fit_decreasing(packing, items):
+    for sku, quantity in items:
+        size = pouch_size(sku)
+        for index in range(len(packing.space)):
+            if quantity == 0:
+                break
+            fit = units_that_fit(packing.space[index], size, quantity)
+            if fit:
+                packing.add(index, sku, fit)
+                quantity -= fit
+        fill_new_bins(packing, sku, size, quantity)
+    return packing
+
+
+def best_fit_decreasing(packing, items):
+    for sku, quantity in items:
+        size = pouch_size(sku)
+        while quantity > 0:
+            candidates = [index for index, space in enumerate(packing.space) if units_that_fit(space, size, 1)]
+            if not candidates:
+                break
+            index = min(candidates, key=lambda index: packing.space[index])
+            fit = units_that_fit(packing.space[index], size, quantity)
+            packing.add(index, sku, fit)
+            quantity -= fit
+        fill_new_bins(packing, sku, size, quantity)
+    return packing
+
+
+def place_units(packing, units, start, budget):
+    if start == len(units):
+        return True
+    budget[0] -= 1
+    if budget[0] < 0:
+        return False
+
+    sku, size, _ = units[start]
+    # Units of the same SKU are interchangeable, so never place one in an earlier bin than its predecessor
+    first_index = units[start - 1][2] if start and units[start - 1][0] == sku else 0
+    tried_empty_bin = False
+    for index in range(first_index, len(packing.space)):
+        if not units_that_fit(packing.space[index], size, 1):
+            continue
+        # Empty bins are interchangeable too
+        if not packing.contents[index]:
+            if tried_empty_bin:
+                continue
+            tried_empty_bin = True
+        packing.add(index, sku, 1)
+        units[start] = (sku, size, index)
+        if place_units(packing, units, start + 1, budget):
+            return True
+        packing.add(index, sku, -1)
+        if not packing.contents[index][sku]:
+            del packing.contents[index][sku]
+    return False
+
+
+# Fewest bins for small orders; first-fit when that's already optimal or the search is too large
+def minimum_bin_packing(packing, items):
+    first_fit = first_fit_decreasing(packing.clone(), items)
+
+    units = sorted(((sku, pouch_size(sku), 0) for sku, quantity in items for _ in range(quantity)), key=lambda unit: unit[1], reverse=True)
+    if not units or len(units) > EXACT_PACKING_MAX_UNITS:
+        return first_fit
+
+    free_space = sum(max(space, 0) for space in packing.space)
+    needed_space = sum(size for _, size, _ in units)
+    min_new_bins = max(math.ceil((needed_space - free_space) / packing.capacity), 0)
+
+    budget = [EXACT_PACKING_MAX_NODES]
+    for total_bins in range(len(packing.space) + min_new_bins, len(first_fit.space)):
+        trial = packing.clone()
+        while len(trial.space) < total_bins:
+            trial.open_bin()
+        if place_units(trial, list(units), 0, budget):
+            return trial
+        if budget[0] < 0:
+            break
+    return first_fit
+
+
+PACKING_STRATEGIES = {
+    'ffd': first_fit_decreasing,
+    'bfd': best_fit_decreasing,
+    'exact': minimum_bin_packing,
+}
 
 
-def first_fit_decreasing(items, otp_lyl_present, existing_bins=None, max_pouches_per_bin=10):
+def pack_bins(items, otp_lyl_present, existing_bins=None, max_pouches_per_bin=10, strategy=None):
     if otp_lyl_present:
         items = [(sku, count) for sku, count in items if sku != 'OTP - LYL']
     items = sorted(items, key=lambda x: x[1], reverse=True)
-    bins = existing_bins if existing_bins else []
-
-    for item in items:
-        remaining_pouches = item[1]
-        while remaining_pouches > 0:
-            found_bin = False
-            for bin in bins:
-                is_first_bin = bins.index(bin) == 0
-                max_pouches = max_pouches_per_bin - (1 if otp_lyl_present and is_first_bin else 0)
-                available_space = max_pouches - sum([config.sku_to_pouches.get(sku, 1) * count for sku, count in bin])
-
-                if available_space >= config.sku_to_pouches.get(item[0], 1):
-                    existing_item = next((bin_item for bin_item in bin if bin_item[0] == item[0]), None)
-                    if existing_item:
-                        index = bin.index(existing_item)
-                        bin[index] = (item[0], existing_item[1] + 1)
-                    else:
-                        bin.append((item[0], 1))
-                    remaining_pouches -= 1
-                    found_bin = True
-                    break
 
-            if not found_bin:
-                bins.append([(item[0], 1)])
-                remaining_pouches -= 1
+    # The first bin (parent order) keeps a slot free for OTP - LYL
+    first_bin_capacity = max_pouches_per_bin - (1 if otp_lyl_present else 0)
+    packing = Packing(max_pouches_per_bin, first_bin_capacity, existing_bins or [])
+    bins = PACKING_STRATEGIES[strategy or PACKING_STRATEGY](packing, items).to_bins()
 
     if otp_lyl_present:
         # Add OTP - LYL back into the first bin (parent order) with hardcoded quantity of 1
@@ -774,8 +2109,60 @@ def first_fit_decreasing(items, otp_lyl_present, existing_bins=None, max_pouches
 
 
 
+# 'cost' compares splits with different box sizes by estimated postage instead of always filling boxes to 10 pouches
+SPLIT_OPTIMIZER = getattr(config, 'SPLIT_OPTIMIZER', 'pouches')
+SPLIT_MIN_BOX_POUCHES = getattr(config, 'SPLIT_MIN_BOX_POUCHES', 5)
+SPLIT_MAX_EXTRA_BOXES = getattr(config, 'SPLIT_MAX_EXTRA_BOXES', 1)
+POUCH_WEIGHT = getattr(config, 'POUCH_WEIGHT', 16)  # Ounces per pouch when the order carries no weight
+
+
+def bin_pouches(bin):
+    return sum(sku_info(sku).pouches * count for sku, count in bin)
+
+
+# Cheapest quote for a typical box of each pouch count
+def estimate_box_rates(order, box_sizes, ounces_per_pouch):
+    quotes = {}
+    for pouches in box_sizes:
+        preset = config.presets.get(str(pouches), {})
+        probe = {
+            'orderNumber': order['orderNumber'],
+            'shipTo': order['shipTo'],
+            'dimensions': preset.get('dimensions', order.get('dimensions')),
+            'weight': {'value': preset.get('weight', {}).get('value', 0) + pouches * ounces_per_pouch, 'units': 'ounces'}
+        }
+        quotes[pouches] = (dispatch_quotes(probe, quote_options(probe)), probe)
+    return {pouches: cheapest_quote(box_quotes, probe)[0] for pouches, (box_quotes, probe) in quotes.items()}
+
+
+# Keeps the packing, at box sizes from SPLIT_MIN_BOX_POUCHES to 10 pouches, with the lowest estimated postage
+def cheapest_split(order, items, otp_lyl_present, existing_bins):
+    candidates = {}
+    for max_pouches in range(10, SPLIT_MIN_BOX_POUCHES - 1, -1):
+        candidates[max_pouches] = pack_bins(items, otp_lyl_present, existing_bins=existing_bins, max_pouches_per_bin=max_pouches)
+    fewest_boxes = len(candidates[10])
+    candidates = {max_pouches: bins for max_pouches, bins in candidates.items() if len(bins) <= fewest_boxes + SPLIT_MAX_EXTRA_BOXES}
+
+    order_pouches = total_pouches(order, True)
+    ounces_per_pouch = order['weight']['value'] / order_pouches if order.get('weight', {}).get('value') and order_pouches else POUCH_WEIGHT
+    box_sizes = {bin_pouches(bin) for bins in candidates.values() for bin in bins}
+    box_rates = estimate_box_rates(order, box_sizes, ounces_per_pouch)
+
+    best_bins, best_cost = candidates[10], None
+    for max_pouches, bins in candidates.items():
+        rates = [box_rates[bin_pouches(bin)] for bin in bins]
+        if None in rates:
+            continue
+        cost = sum(rates)
+        if best_cost is None or cost < best_cost:
+            best_bins, best_cost = bins, cost
+    if best_cost is not None:
+        print(f"(Log for #{order['orderNumber']}) Cheapest split: {len(best_bins)} boxes of {[bin_pouches(bin) for bin in best_bins]} pouches, estimated ${best_cost:.2f}", flush=True)
+    return best_bins
+
+
 def prepare_split_data(order, mlp_data, need_gnome):
-    original_order = copy.deepcopy(order)
+    original_order = derive_order(order)
     child_orders = []
     
     hero_skus = ["SUB - HERO - S", "SUB - HERO - G"]
@@ -798,14 +2185,18 @@ def prepare_split_data(order, mlp_data, need_gnome):
                 hero_bins["SUB - HERO - G"].append([("2" + item['sku'], 1)])
     
                 
-    otp_lyl_present = any('LYL' in item['sku'] for item in original_order['items'])
+    otp_lyl_present = any(sku_info(item['sku']).lyl for item in original_order['items'])
     stk_order = otp_lyl_present
 
     existing_bins = []
     for bins in hero_bins.values():
         existing_bins.extend(bins)
 
-    bins = first_fit_decreasing(items_with_quantity, otp_lyl_present, existing_bins=existing_bins)
+    with current_metrics.get().timer('StageLatency', 'Stage', 'packing'):
+        if SPLIT_OPTIMIZER == 'cost':
+            bins = cheapest_split(order, items_with_quantity, otp_lyl_present, existing_bins)
+        else:
+            bins = pack_bins(items_with_quantity, otp_lyl_present, existing_bins=existing_bins)
     
     
     stk_item = next(
@@ -822,7 +2213,7 @@ def prepare_split_data(order, mlp_data, need_gnome):
         # Extract and divide the green sprayers
         green_sprayers = mlp_data.get('OTP - HES - G', [{'count': 0}])[0]['count']
         # Identify bins that should receive sprayers
-        sprayer_bins = [bin for bin in bins if not {sku for sku, quantity in bin}.issubset(config.non_sprayer_skus)] # Changed bins[1:] to bins
+        sprayer_bins = [bin for bin in bins if any(sku_info(sku).sprayer_eligible for sku, quantity in bin)] # Changed bins[1:] to bins
         num_sprayer_bins = len(sprayer_bins)
         sprayers_per_order = green_sprayers // num_sprayer_bins
         remainder = green_sprayers % num_sprayer_bins
@@ -833,12 +2224,11 @@ def prepare_split_data(order, mlp_data, need_gnome):
         mlp_data['OTP - HES - G'][0]['count'] = sprayers_per_order + (remainder > 0)
 
     # Yellow Sprayers
-    yellow_sprayer_skus = ['SUB - LG - D', 'SUB - LG - S', 'SUB - LG - G', 'OTP - WNF', "SUB - HERO - D", "1SUB - HERO - S", "2SUB - HERO - G"]
     if 'OTP - HES - Y' in mlp_data:
         # Extract and divide the yellow sprayers
         yellow_sprayers = mlp_data.get('OTP - HES - Y', [{'count': 0}])[0]['count']
         # Identify bins that should receive yellow sprayers
-        yellow_sprayer_bins = [bin for bin in bins if any(sku in yellow_sprayer_skus for sku, quantity in bin)] # Changed bins[1:] to bins
+        yellow_sprayer_bins = [bin for bin in bins if any(sku_info(sku).yellow_sprayer for sku, quantity in bin)] # Changed bins[1:] to bins
         num_yellow_sprayer_bins = len(yellow_sprayer_bins)
         yellow_sprayers_per_order = yellow_sprayers // num_yellow_sprayer_bins
         yellow_remainder = yellow_sprayers % num_yellow_sprayer_bins
@@ -860,7 +2250,7 @@ def prepare_split_data(order, mlp_data, need_gnome):
         parent_item = next(
             (x for x in parent_items if x[0] == item['sku']), None)
         if parent_item:
-            item_copy = copy.deepcopy(item)
+            item_copy = dict(item)
             item_copy['quantity'] = parent_item[1]
             if item['sku'] == 'SUB - HERO - S':
                 item_copy['name'] = config.hero_standard[0]
@@ -870,42 +2260,34 @@ def prepare_split_data(order, mlp_data, need_gnome):
     original_order['items'] = original_order_items
     order_pouches = total_pouches(original_order)
     original_order = set_order_tags(original_order, order, order_pouches)
-    if any('HERO' in item['sku'] for item in original_order['items']):
+    if any(sku_info(item['sku']).hero for item in original_order['items']):
         original_order['items'].append(config.golden_gnome)
     elif need_gnome:
         original_order['items'].append(config.gnome)
+    to_rate_shop = []
     if stk_order:
         original_order = apply_preset_based_on_pouches(
-            original_order, mlp_data, order_pouches, is_parent=True, use_stk_preset=True
+            original_order, mlp_data, order_pouches, to_rate_shop, is_parent=True, use_stk_preset=True
         )
     else:
         original_order = apply_preset_based_on_pouches(
-            original_order, mlp_data, order_pouches, is_parent=True
+            original_order, mlp_data, order_pouches, to_rate_shop, is_parent=True
         )
-    with ThreadPoolExecutor(max_workers=len(bins) - 1) as executor:
-        args_list = [
-            (bin_index, bin, order, mlp_data, total_shipments)
-            for bin_index, bin in enumerate(bins[1:])
-        ]
-        child_orders = []
-        for result in executor.map(prepare_child_order, args_list):
-            child_orders.append(result)
+    child_orders = [
+        prepare_child_order(bin_index, bin, order, mlp_data, total_shipments, to_rate_shop)
+        for bin_index, bin in enumerate(bins[1:])
+    ]
     original_order['orderNumber'] = f"{original_order['orderNumber']}-1"
     original_order['advancedOptions']['customField3'] = f"Shipment 1 of {total_shipments}"
-    print(f"(Log for #{order['orderNumber']}) Parent order for {order['orderNumber']}: {original_order}", flush=True)
-    print(f"(Log for #{order['orderNumber']}) Child orders for {order['orderNumber']}: {child_orders}", flush=True)
-    return original_order, child_orders
+    # Carrier quotes for the shipments are left to execute_plans
+    return original_order, child_orders, to_rate_shop
 
 
 
-def prepare_child_order(args):
-    bin_index, bin, parent_order, mlp_data, total_shipments = args
+def prepare_child_order(bin_index, bin, parent_order, mlp_data, total_shipments, to_rate_shop):
 
-    child_order = copy.deepcopy(parent_order)
-    if 'orderId' in child_order:
-        del child_order['orderId']
-    child_order['tagIds'] = []
-    child_order['orderNumber'] = f"{parent_order['orderNumber']}-{bin_index+2}"
+    child_order = derive_order(parent_order, tagIds=[], orderNumber=f"{parent_order['orderNumber']}-{bin_index+2}")
+    child_order.pop('orderId', None)
     child_order['advancedOptions']['customField1'] = ''
     child_order['advancedOptions']['customField3'] = f"Shipment {bin_index+2} of {total_shipments}"
     
@@ -917,10 +2299,10 @@ def prepare_child_order(args):
             temp_sku = sku[1:]
         item = next((i for i in parent_order['items'] if i['sku'] == temp_sku), None)
         if item is not None:
-            item_copy = copy.deepcopy(item)
+            item_copy = dict(item)
             item_copy['quantity'] = item_count
             if item_copy['quantity'] > 0:
-                child_pouches += item_copy['quantity'] * config.sku_to_pouches.get(sku, 0)
+                child_pouches += item_copy['quantity'] * sku_info(sku).pouches
                 if sku == '1SUB - HERO - S':
                     item_copy['name'] = config.hero_standard[1]
                     item_copy['sku'] = 'SUB - HERO - S'
@@ -941,9 +2323,12 @@ def prepare_child_order(args):
             continue
     child_order['items'] = child_order_items
     child_order['orderTotal'] = 0.00
-    child_order['orderKey'] = str(uuid.uuid4())
+    # Derived from the parent's key and the shipment number, so running the same order again updates its child
+    # shipments in ShipStation instead of creating duplicates
+    parent_key = parent_order.get('orderKey') or parent_order['orderNumber']
+    child_order['orderKey'] = str(uuid.uuid5(uuid.NAMESPACE_OID, f"{parent_key}/{bin_index+2}"))
 
-    child_order = apply_preset_based_on_pouches(child_order, mlp_data, child_pouches)
+    child_order = apply_preset_based_on_pouches(child_order, mlp_data, child_pouches, to_rate_shop)
 
     child_order = set_order_tags(child_order, parent_order, child_pouches)
 
@@ -1,56 +1,192 @@
+import time
+# Taken before anything else is imported, so INIT_DURATION covers the whole module load on a cold start
+INIT_STARTED = time.perf_counter()
+
+import os
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import functions
-import time
+import config
+
+# Orders in flight at once. An order waiting on I/O is a suspended task, not a thread, so this can exceed the pools below
+ORDER_CONCURRENCY = getattr(config, 'ORDER_CONCURRENCY', 32)
+
+# The event loop only schedules work: requests is blocking, so every call still runs on a thread from one of two
+# fixed pools. Planning is CPU-bound under the GIL and gains nothing from more threads;
+# outbound requests go to functions.io_executor, so order workers never wait on their own pool. Together the pools
+# (4 + 16 threads by default) stay under the old 9 order threads and the quote and item pools each of them opened.
+PIPELINE_WORKERS = getattr(config, 'PIPELINE_WORKERS', 4)
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
+
+# Planned orders are rated and queued together, so quotes shared between orders in a batch are requested once
+EXECUTE_BATCH_SIZE = getattr(config, 'EXECUTE_BATCH_SIZE', 50)
+
+INIT_DURATION = round((time.perf_counter() - INIT_STARTED) * 1000, 3)
+# Cleared by the first invocation, so only cold starts report INIT_DURATION
+cold_start = True
+
+
+def run_blocking(executor, function, *args):
+    # Run in the given pool with this task's context, so metrics are attributed to the task's order
+    return asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, function, *args)
+
+
+async def enrich_order(order):
+    # Fill the MLP memo so processor() finds the order's plan details without another round-trip
+    if functions.needs_mlp_lookup(order):
+        order_number = order['orderNumber'].split("-")[0]
+        try:
+            await run_blocking(functions.io_executor, functions.fetch_mlp_record, order_number)
+        except Exception as e:
+            # processor() will make its own attempt for this order
+            print(f"(Log for #{order_number}) Error fetching MLP data: {e}", flush=True)
+
+
+async def execute_batch(planned):
+    batch = planned[:]
+    planned.clear()
+    plans = [plan for plan, _ in batch]
+    try:
+        await run_blocking(pipeline_executor, functions.execute_plans, plans)
+    except Exception as e:
+        # Only this batch's orders fail; their shipments still waiting for a bulk submission are withdrawn
+        functions.discard_submissions(plans)
+        for plan in plans:
+            functions.current_ledger.get().fail(plan['orderNumber'], 'error')
+        print(f"Error executing batch of {len(plans)} orders: {e!r}", flush=True)
+        return
+    # Time from picking the order up to its shipments being rated and queued for submission
+    for plan, started in batch:
+        functions.current_metrics.get().record('PipelineLatency', round((time.perf_counter() - started) * 1000, 3), order_number=plan['orderNumber'])
+
+
+async def handle_order(order, semaphore, planned, claims):
+    started = time.perf_counter()
+    # Each task runs in its own context, so this only tags work done for this order
+    functions.current_order.set(order['orderNumber'])
+    async with semaphore:
+        try:
+            claim = await run_blocking(functions.io_executor, functions.claim_order, order)
+            if claim is None:
+                return
+            # Recorded before anything else can fail, so run_pipeline still settles the claim
+            claims[order['orderNumber']] = claim
+            await enrich_order(order)
+            plan = await run_blocking(pipeline_executor, functions.processor, order)
+        except Exception as e:
+            # One malformed order shouldn't take down the rest of the invocation
+            functions.current_ledger.get().fail(order['orderNumber'], 'error')
+            print(f"(Log for #{order['orderNumber']}) Error processing order: {e!r}", flush=True)
+            return
+
+    # The event loop is single-threaded, so the shared list needs no lock
+    planned.append((plan, started))
+    if len(planned) >= EXECUTE_BATCH_SIZE:
+        await execute_batch(planned)
+
+
+# Orders are planned as they arrive from the iterator, then rated and queued in batches
+async def run_pipeline(orders):
+    semaphore = asyncio.Semaphore(ORDER_CONCURRENCY)
+    planned = []
+    tasks = []
+    order_numbers = []
+    # Order number -> idempotency claim, filled in as orders are claimed so a failure anywhere below still settles them
+    claims = {}
+    try:
+        while True:
+            order = await run_blocking(functions.io_executor, next, orders, None)
+            if order is None:
+                break
+            order_numbers.append(order['orderNumber'])
+            tasks.append(asyncio.create_task(handle_order(order, semaphore, planned, claims)))
+        await asyncio.gather(*tasks)
+
+        if planned:
+            await execute_batch(planned)
+
+        # Submit whatever is left over from the bulk batches filled during processing
+        await run_blocking(functions.io_executor, functions.flush_submissions)
+    finally:
+        # No claim outlives the invocation, even one that crashed: orders whose shipments were all created are marked
+        # done and the rest released for the next webhook. Orders still in flight are let finish first
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*(run_blocking(functions.io_executor, functions.finish_order, order_number, claim)
+                               for order_number, claim in claims.items()))
+
+    return order_numbers
+
 
 def lambda_handler(event, context):
+    global cold_start
+    functions.mlp_responses.clear()
+    # Anything a crashed invocation left queued belongs to orders it never finished; they get planned again
+    with functions.submission_lock:
+        functions.pending_submissions.clear()
+    # Set before the event loop starts, so every task and pool thread of this invocation inherits them
+    metrics = functions.Metrics()
+    functions.current_metrics.set(metrics)
+    ledger = functions.ResultLedger()
+    functions.current_ledger.set(ledger)
+
+    if cold_start:
+        cold_start = False
+        metrics.record('InitDuration', INIT_DURATION, per_order=False)
+        print(f"Cold start: module init took {INIT_DURATION} ms")
 
-    # Filters out child orders when they reactivate this function after being created in Shipstation
-    orders = [order for order in functions.extract_data_from_resource_url(event) if "-" not in order['orderNumber'] and order['orderStatus'] == 'awaiting_shipment']
-    if orders:
-        print(f"{len(orders)} processable orders: {[order['orderNumber'] for order in orders]}")
+    # A dry run goes through the whole pipeline but quotes from local rates and returns payloads instead of submitting them
+    dry_run = event.get('dry_run') or os.environ.get('DRY_RUN', '').lower() in ('1', 'true', 'yes')
+    functions.dry_run = functions.DryRun(event.get('rates'), event.get('mlp')) if dry_run else None
+    if dry_run:
+        print("Dry run: nothing will be submitted to ShipStation")
+
+    orders = functions.extract_inline_orders(event) if 'orders' in event else functions.extract_data_from_resource_url(event)
+    order_numbers = asyncio.run(run_pipeline(orders))
+    # Persist what this invocation's quotes taught the rate table, when RATE_TABLE_PATH points at shared storage
+    functions.rate_table.save()
+    if order_numbers:
+        print(f"{len(order_numbers)} processable orders: {order_numbers}")
+        print(f"Rate cache: {metrics.count('RateCacheHits')} hits, {metrics.count('RateCacheMisses')} misses")
     else:
         print(f"Unable to extract order information from resource URL; function execution ending")
-        return
 
-    with ThreadPoolExecutor(max_workers=9) as executor:
-        futures = [executor.submit(functions.processor, order) for order in orders]
-        for future in as_completed(futures):
-            future.result()
+    timed_out = ledger.with_reason('rate_timeout')
+    if timed_out:
+        print(f"Carrier rate quotes timed out for {len(timed_out)} shipments: {timed_out}")
 
-    if len(functions.failed) == 0:
-        print("All orders processed successfully!")
+    paced = ledger.with_reason('rate_paced')
+    if paced:
+        print(f"ShipStation carriers skipped by the request pacer for {len(paced)} shipments: {paced}")
+
+    incomplete_fetch = ledger.incomplete_fetch
+    if incomplete_fetch:
+        print(f"Gave up fetching the resource URL at page {incomplete_fetch['page']} of {incomplete_fetch['pages']}; "
+              f"orders on the remaining pages were not processed")
+
+    failed = ledger.with_status('failed')
+    if not failed:
+        if order_numbers and not incomplete_fetch:
+            print("All orders processed successfully!")
     else:
-        print(f"Failed to process {len(functions.failed)} orders: {functions.failed}")
-        if functions.no_mlp_or_sprayer_data:
-            print(f"Unable to pull MLP / sprayer data for {len(functions.no_mlp_or_sprayer_data)} orders: {functions.no_mlp_or_sprayer_data}")
-        if functions.no_mlp_data:
-            print(f"Unable to pull lawn plan products for {len(functions.no_mlp_data)} orders: {functions.no_mlp_data}")
-        if functions.no_rate:
-            print(f"Unable to get carrier rates for {len(functions.no_rate)} orders: {functions.no_rate}")
-
-        if len(functions.rate_limited) > 0:
-            print(f"Rate-limited on {len(functions.rate_limited)} orders: {order['orderNumber'] for order in functions.rate_limited}")
-            print(f"Retrying rate-limited orders in 1 minute...")
-            time.sleep(60)
-            print(f"Now retrying rate-limited orders")
-
-            rate_limited_orders = functions.rate_limited.copy()
-
-            functions.failed = []
-            functions.rate_limited = []
-            with ThreadPoolExecutor(max_workers=9) as executor:
-                futures = [executor.submit(functions.processor, order) for order in rate_limited_orders]
-                for future in as_completed(futures):
-                    future.result()
-
-            if len(functions.failed) == 0:
-                print("All orders processed successfully!")
-            else:
-                print(f"Second processing attempt failed on {len(functions.failed)} orders: {functions.failed}")
+        print(f"Failed to process {len(failed)} orders: {failed}")
+        for reason, message in [('no_mlp_or_sprayer_data', "Unable to pull MLP / sprayer data for"),
+                                ('no_mlp_data', "Unable to pull lawn plan products for"),
+                                ('no_rate', "Unable to get carrier rates for"),
+                                ('rate_limited', "Still rate-limited after retries on")]:
+            order_numbers = ledger.with_reason(reason)
+            if order_numbers:
+                print(f"{message} {len(order_numbers)} orders: {order_numbers}")
+
+    metrics.emit()
 
+    body = ledger.summary()
+    if dry_run:
+        body['dryRun'] = True
+        body['payloads'] = functions.dry_run.payloads
 
     return {
         'statusCode': 200,
-        'body': json.dumps('Lambda function executed successfully')
+        'body': json.dumps(body)
     }
@@ -0,0 +1,27 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # config.py holds credentials and isn't checked in; these tests only need a catalog to import functions against
+    config = types.ModuleType('config')
+    config.SHIPSTATION_API_KEY = config.SHIPSTATION_API_SECRET = config.x_partner = ''
+    config.FEDEX_ACCT_NO = config.FEDEX_API_KEY = config.FEDEX_API_SECRET = ''
+    config.UPS_ACCESS_KEY = config.UPS_CLIENT_ID = config.UPS_CLIENT_SECRET = config.UPS_USERNAME = config.UPS_PW = ''
+    config.sku_to_pouches = {}
+    config.hero_base_pouches = {}
+    config.SKU_REPLACEMENTS = {}
+    config.product_weights = {}
+    config.non_sprayer_skus = []
+    config.non_plan_subs = []
+    config.amazon_otp_skus = []
+    config.presets = {}
+    config.presets_with_stk = {}
+    config.mosquito_only_preset = {}
+    config.stk_only = {}
+    config.other_usps_items = {}
+    sys.modules['config'] = config
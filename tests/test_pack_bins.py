@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+import config
+import functions
+
+# Pouches per unit for the SKUs these tests pack
+POUCHES = {'OTP - A': 1, 'OTP - B': 2, 'OTP - C': 3, 'SUB - MLP - S': 4, 'OTP - LYL': 1, 'OTP - STK': 0}
+
+
+@pytest.fixture(autouse=True)
+def catalog(monkeypatch):
+    monkeypatch.setattr(config, 'sku_to_pouches', POUCHES, raising=False)
+    monkeypatch.setattr(functions, 'sku_catalog', {})
+
+
+def legacy_first_fit_decreasing(items, otp_lyl_present, max_pouches_per_bin=10):
+    # The unit-by-unit packing pack_bins replaced, kept to pin 'ffd' to what orders have always shipped with
+    if otp_lyl_present:
+        items = [(sku, count) for sku, count in items if sku != 'OTP - LYL']
+    items = sorted(items, key=lambda x: x[1], reverse=True)
+    bins = []
+    for sku, quantity in items:
+        for _ in range(quantity):
+            for index, bin in enumerate(bins):
+                max_pouches = max_pouches_per_bin - (1 if otp_lyl_present and index == 0 else 0)
+                if max_pouches - sum(POUCHES[bin_sku] * count for bin_sku, count in bin) >= POUCHES[sku]:
+                    existing = next((position for position, (bin_sku, _) in enumerate(bin) if bin_sku == sku), None)
+                    if existing is None:
+                        bin.append((sku, 1))
+                    else:
+                        bin[existing] = (sku, bin[existing][1] + 1)
+                    break
+            else:
+                bins.append([(sku, 1)])
+    if otp_lyl_present:
+        bins[0].append(('OTP - LYL', 1))
+    return bins
+
+
+def random_items(rng, skus=('OTP - A', 'OTP - B', 'OTP - C', 'SUB - MLP - S')):
+    return [(sku, rng.randint(1, 6)) for sku in rng.sample(skus, rng.randint(1, len(skus)))]
+
+
+def bin_load(bin):
+    return sum(POUCHES[sku] * count for sku, count in bin if sku != 'OTP - LYL')
+
+
+def unit_counts(bins):
+    counts = {}
+    for bin in bins:
+        for sku, count in bin:
+            counts[sku] = counts.get(sku, 0) + count
+    return counts
+
+
+def test_default_strategy_is_first_fit():
+    assert functions.PACKING_STRATEGY == 'ffd'
+
+
+def test_ffd_matches_legacy_packing():
+    rng = random.Random(7)
+    for _ in range(2000):
+        items = random_items(rng)
+        assert functions.pack_bins(items, False, strategy='ffd') == legacy_first_fit_decreasing(items, False)
+
+
+@pytest.mark.parametrize('strategy', sorted(functions.PACKING_STRATEGIES))
+@pytest.mark.parametrize('otp_lyl_present', [False, True])
+def test_bins_respect_capacity_and_keep_every_unit(strategy, otp_lyl_present):
+    rng = random.Random(11)
+    for _ in range(500):
+        items = random_items(rng)
+        max_pouches = rng.randint(5, 10)
+        bins = functions.pack_bins(items + ([('OTP - LYL', 1)] if otp_lyl_present else []), otp_lyl_present,
+                                   max_pouches_per_bin=max_pouches, strategy=strategy)
+
+        expected = dict(items)
+        if otp_lyl_present:
+            expected['OTP - LYL'] = 1
+        assert unit_counts(bins) == expected
+        for index, bin in enumerate(bins):
+            # The parent shipment keeps one pouch free for OTP - LYL
+            capacity = max_pouches - (1 if otp_lyl_present and index == 0 else 0)
+            assert bin_load(bin) <= capacity
+            assert bin
+
+
+@pytest.mark.parametrize('strategy', sorted(functions.PACKING_STRATEGIES))
+def test_otp_lyl_goes_only_in_the_parent_shipment(strategy):
+    bins = functions.pack_bins([('OTP - LYL', 3), ('OTP - A', 10), ('OTP - C', 2)], True, strategy=strategy)
+    assert bins[0][-1] == ('OTP - LYL', 1)
+    assert bin_load(bins[0]) <= 9
+    assert all(sku != 'OTP - LYL' for bin in bins[1:] for sku, _ in bin)
+
+
+def test_exact_never_uses_more_boxes_than_ffd():
+    rng = random.Random(13)
+    for _ in range(500):
+        items = random_items(rng)
+        exact = functions.pack_bins(items, False, strategy='exact')
+        assert len(exact) <= len(functions.pack_bins(items, False, strategy='ffd'))
+
+
+def test_exact_finds_fewer_boxes_where_first_fit_wastes_space():
+    # First-fit puts 3 + 3 + 3 in the first box and can't fit the 4s together; 3 + 3 + 4 twice fits in two
+    items = [('OTP - C', 4), ('SUB - MLP - S', 2)]
+    assert len(functions.pack_bins(items, False, strategy='ffd')) == 3
+    bins = functions.pack_bins(items, False, strategy='exact')
+    assert len(bins) == 2
+    assert all(bin_load(bin) <= 10 for bin in bins)
+
+
+def test_existing_bins_are_filled_before_new_ones():
+    bins = functions.pack_bins([('OTP - A', 3)], False, existing_bins=[[('SUB - MLP - S', 2)]], strategy='ffd')
+    assert bins == [[('SUB - MLP - S', 2), ('OTP - A', 2)], [('OTP - A', 1)]]
+
+
+def test_zero_pouch_items_ride_along_in_the_first_box():
+    bins = functions.pack_bins([('OTP - STK', 1), ('OTP - A', 10)], False, strategy='ffd')
+    assert bins == [[('OTP - A', 10), ('OTP - STK', 1)]]
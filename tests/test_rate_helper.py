@@ -0,0 +1,39 @@
+import pytest
+
+import functions
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+        self.headers = {}
+
+
+@pytest.fixture(autouse=True)
+def fedex(monkeypatch):
+    monkeypatch.setattr(functions, 'dry_run', None)
+    monkeypatch.setattr(functions, 'RETRY_BASE_DELAY', 0)
+    monkeypatch.setattr(functions, 'rate_cache', functions.RateCache(functions.RATE_CACHE_TTL, functions.RATE_CACHE_MAX_ENTRIES))
+    monkeypatch.setitem(functions.circuit_breakers, 'fedex', functions.CircuitBreaker('fedex'))
+    monkeypatch.setattr(functions, 'get_fedex_access_token', lambda: 'token')
+
+
+def shipment(order_number):
+    return {'orderNumber': order_number, 'weight': {'value': 32, 'units': 'ounces'},
+            'shipTo': {'postalCode': '90210', 'residential': True}}
+
+
+def test_rejected_shipments_leave_the_circuit_closed(monkeypatch):
+    monkeypatch.setattr(functions.session, 'post', lambda *args, **kwargs: Response(400))
+    for number in range(functions.CIRCUIT_FAILURE_THRESHOLD):
+        assert functions.rate_helper(functions.get_fedex_rate, shipment(str(number)), 'fedex', 'fedex_home_delivery') is None
+    assert functions.circuit_breakers['fedex'].state == 'closed'
+
+
+def test_server_errors_open_the_circuit(monkeypatch):
+    monkeypatch.setattr(functions.session, 'post', lambda *args, **kwargs: Response(503))
+    for number in range(functions.CIRCUIT_FAILURE_THRESHOLD):
+        with pytest.raises(functions.RateUnavailable):
+            functions.rate_helper(functions.get_fedex_rate, shipment(str(number)), 'fedex', 'fedex_home_delivery')
+    assert functions.circuit_breakers['fedex'].state == 'open'